@@ -0,0 +1,60 @@
+"""Benchmarks of the helper functions for scrubbing, compcor and motion PCA."""
+import numpy as np
+import pandas as pd
+import pytest
+from load_confounds import confounds as cf
+from load_confounds import compcor
+from load_confounds.parser import motion_basic
+
+
+n_scans_grid = [200, 1000, 5000, 100000]
+n_components_grid = [50, 500, 2000]
+
+
+@pytest.mark.parametrize("n_scans", n_scans_grid)
+def test_optimize_scrub(benchmark, n_scans):
+    """Time the removal of short segments, with 10% of outliers."""
+    outliers = np.random.RandomState(0).rand(n_scans) < 0.1
+    benchmark(cf._optimize_scrub, outliers)
+
+
+def _compcor_json(n_components):
+    """Json data of anatomical and temporal compcor components."""
+    confounds_json = {}
+    for ind in range(n_components):
+        mask = ["combined", "CSF", "WM"][3 * ind // n_components]
+        confounds_json[f"a_comp_cor_{ind:02d}"] = {"Method": "aCompCor", "Mask": mask}
+        confounds_json[f"t_comp_cor_{ind:02d}"] = {"Method": "tCompCor"}
+    return confounds_json
+
+
+@pytest.mark.parametrize("acompcor_combined", [True, False])
+@pytest.mark.parametrize("n_components", n_components_grid)
+def test_find_compcor(benchmark, n_components, acompcor_combined):
+    """Time the selection of compcor components, without cached plans."""
+    confounds_json = _compcor_json(n_components)
+
+    def setup():
+        compcor._layouts.clear()
+        return (confounds_json, "full", 10, acompcor_combined), {}
+
+    benchmark.pedantic(compcor._find_compcor, setup=setup, rounds=20)
+
+
+@pytest.mark.parametrize("n_components", n_components_grid)
+def test_find_compcor_cached(benchmark, n_components):
+    """Time the selection of compcor components, with a cached plan."""
+    confounds_json = _compcor_json(n_components)
+    benchmark(compcor._find_compcor, confounds_json, "full", 10, False)
+
+
+@pytest.mark.parametrize("n_motion", [6, 0.95])
+@pytest.mark.parametrize("n_scans", n_scans_grid)
+def test_pca_motion(benchmark, n_scans, n_motion):
+    """Time the PCA of the full motion parameters of a run."""
+    params = cf._add_suffix(motion_basic, "full")
+    motion = pd.DataFrame(
+        np.random.RandomState(0).randn(n_scans, len(params)), columns=params
+    )
+    motion.iloc[0, 6:] = np.nan  # derivatives
+    benchmark(cf._pca_motion, motion, n_motion)
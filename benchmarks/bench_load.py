@@ -0,0 +1,55 @@
+"""Benchmarks of loading confounds."""
+import pytest
+from load_confounds import Confounds, Minimal, Scrubbing, CompCor, ICAAROMA
+from load_confounds import confounds as cf
+from conftest import aroma_file
+
+
+# grid of run lengths, numbers of columns and numbers of runs
+n_scans_grid = [200, 1000, 5000]
+n_columns_grid = [50, 500, 2000]
+n_runs_grid = [1, 10, 100]
+
+
+def _bench_load(benchmark, conf, img_files):
+    """Time loading runs, with the in-memory cache emptied before each round."""
+
+    def setup():
+        cf.clear_cache()
+        return (img_files,), {}
+
+    benchmark.pedantic(conf.load, setup=setup, rounds=5)
+
+
+@pytest.mark.parametrize("n_columns", n_columns_grid)
+@pytest.mark.parametrize("n_scans", n_scans_grid)
+def test_load(benchmark, make_runs, n_scans, n_columns):
+    """Time loading a run with the default strategy."""
+    _bench_load(benchmark, Confounds(), make_runs(n_scans, n_columns))
+
+
+@pytest.mark.parametrize("n_runs", n_runs_grid)
+def test_load_runs(benchmark, make_runs, n_runs):
+    """Time loading several runs of 500 volumes and 200 columns."""
+    _bench_load(benchmark, Confounds(), make_runs(500, 200, n_runs))
+
+
+@pytest.mark.parametrize("n_columns", n_columns_grid)
+def test_load_cached(benchmark, make_runs, n_columns):
+    """Time loading a run of 1000 volumes from the in-memory cache."""
+    conf = Confounds()
+    img_files = make_runs(1000, n_columns)
+    conf.load(img_files)
+    benchmark(conf.load, img_files)
+
+
+@pytest.mark.parametrize(
+    "strategy", [Minimal, Scrubbing, CompCor, ICAAROMA], ids=lambda s: s.__name__
+)
+@pytest.mark.parametrize("n_scans", n_scans_grid)
+def test_strategy(benchmark, make_runs, strategy, n_scans):
+    """Time loading a run of 500 columns with each predefined strategy."""
+    img_files = make_runs(n_scans, 500)
+    if strategy is ICAAROMA:
+        img_files = [aroma_file(img_file) for img_file in img_files]
+    _bench_load(benchmark, strategy(), img_files)
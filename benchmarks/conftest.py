@@ -0,0 +1,37 @@
+"""Synthetic fMRIprep derivatives shared by the benchmarks."""
+import pytest
+from load_confounds.synthetic import make_confounds, make_derivatives, aroma_suffix
+
+
+def aroma_file(img_file):
+    """Get the ICA-AROMA image of a synthetic run."""
+    return img_file.split("_space-")[0] + aroma_suffix
+
+
+def _n_aroma(n_scans, n_columns):
+    """
+    Number of ICA-AROMA components to get about `n_columns` confounds.
+    Long runs have many cosines, so they have a minimal number of confounds.
+    """
+    n_base = make_confounds(n_scans, n_aroma=0)[0].shape[1]
+    return max(n_columns - n_base, 0)
+
+
+@pytest.fixture(scope="session")
+def make_runs(tmp_path_factory):
+    """Write synthetic runs, shared by all benchmarks with the same grid point."""
+    runs = {}
+
+    def _make_runs(n_scans, n_columns, n_runs=1):
+        key = (n_scans, n_columns, n_runs)
+        if key not in runs:
+            folder = tmp_path_factory.mktemp(f"runs_{n_scans}_{n_columns}_{n_runs}")
+            runs[key] = make_derivatives(
+                folder,
+                n_subjects=n_runs,
+                n_volumes=n_scans,
+                n_aroma=_n_aroma(n_scans, n_columns),
+            )
+        return runs[key]
+
+    return _make_runs
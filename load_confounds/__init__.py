@@ -1,5 +1,11 @@
 """loading fMRIprep confounds into python."""
-from load_confounds.parser import Confounds
+from load_confounds.parser import Confounds, load_many
+from load_confounds.derivatives import DerivativesIndex
+from load_confounds.store import ConfoundsStore
+from load_confounds.parquet import export_parquet, read_parquet
+from load_confounds.profiling import Profiler
+from load_confounds.confounds import outlier_regressors
+from load_confounds.regression import clean, clean_img
 from load_confounds.strategies import (
     Minimal,
     Scrubbing,
@@ -9,6 +15,15 @@ from load_confounds.strategies import (
 
 __all__ = [
     "Confounds",
+    "load_many",
+    "DerivativesIndex",
+    "ConfoundsStore",
+    "export_parquet",
+    "read_parquet",
+    "Profiler",
+    "outlier_regressors",
+    "clean",
+    "clean_img",
     "Minimal",
     "Scrubbing",
     "CompCor",
@@ -1,33 +1,78 @@
 """Helper function for _load_compcor."""
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
 
 
 prefix_compcor = {"full": ["t", "a"], "temp": ["t"], "anat": ["a"]}
 anat_masker = {True: ["combined"], False: ["WM", "CSF"], None: None}
 
+# compcor layouts, shared by all the runs with the same compcor metadata
+_layouts = OrderedDict()
+_layouts_lock = threading.Lock()
+_layouts_size = 64
+
 
 def _find_compcor(confounds_json, compcor, n_compcor, acompcor_combined):
     """Builds list for the number of compcor components."""
     prefix_set, anat_mask = _check_compcor_method(compcor, acompcor_combined)
+    layout = _compcor_layout(confounds_json)
+    key = (compcor, n_compcor, acompcor_combined)
+    plan = layout["plans"].get(key)
+    if plan is None:
+        index = layout["index"]
+        collector = []
+        for prefix in prefix_set:
+            if prefix == "a":
+                # apply acompor mask option if relevant, and select top components
+                collector += _acompcor_mask(index["a"], anat_mask, n_compcor)
+            else:
+                # select top components
+                collector += _select_compcor(index[prefix], n_compcor)
+        plan = layout["plans"][key] = tuple(collector)
+    return list(plan)
 
-    collector = []
-    for prefix in prefix_set:
-        # all possible compcor confounds in order, mixing different types of mask
-        all_compcor_name = [
-            comp for comp in confounds_json.keys() if f"{prefix}_comp_cor" in comp
-        ]
-        # filter by prefix first (anat vs temp)
-        compcor_cols_filt = _prefix_confound_filter(prefix, all_compcor_name)
-        if prefix == "a":
-            # apply acompor mask option if relevant, and select top components
-            compcor_cols_filt = _acompcor_mask(
-                confounds_json, anat_mask, compcor_cols_filt, n_compcor
-            )
+
+def _compcor_metadata(confounds_json):
+    """Extract the compcor components and their masks from the confounds json."""
+    return tuple(
+        (col, meta.get("Mask") if isinstance(meta, Mapping) else None)
+        for col, meta in confounds_json.items()
+        if "_comp_cor" in col
+    )
+
+
+def _compcor_layout(confounds_json):
+    """
+    Get the compcor index and selection plans of a confounds json.
+    They are built once, and shared by all jsons with the same compcor metadata.
+    """
+    metadata = _compcor_metadata(confounds_json)
+    with _layouts_lock:
+        layout = _layouts.get(metadata)
+        if layout is None:
+            layout = {"index": _compcor_index(metadata), "plans": {}}
+            _layouts[metadata] = layout
+            if len(_layouts) > _layouts_size:
+                _layouts.popitem(last=False)
         else:
-            # select top components
-            compcor_cols_filt = _select_compcor(compcor_cols_filt, n_compcor)
-        # Aggregate components across all masks
-        collector += compcor_cols_filt
-    return collector
+            _layouts.move_to_end(metadata)
+    return layout
+
+
+def _compcor_index(metadata):
+    """
+    Index the compcor components by prefix.
+    Anatomical components are paired with their mask.
+    """
+    masks = dict(metadata)
+    index = {}
+    for prefix in ["t", "a"]:
+        # all possible compcor confounds in order, mixing different types of mask
+        all_compcor_name = [col for col in masks if f"{prefix}_comp_cor" in col]
+        index[prefix] = _prefix_confound_filter(prefix, all_compcor_name)
+    index["a"] = [(col, masks.get(col)) for col in index["a"]]
+    return index
 
 
 def _select_compcor(compcor_cols, n_compcor):
@@ -51,23 +96,19 @@ def _check_compcor_method(compcor, acompcor_combined):
     return prefix_set, anat_mask
 
 
-def _acompcor_mask(confounds_json, anat_mask, compcor_cols_filt, n_compcor):
+def _acompcor_mask(acompcor_index, anat_mask, n_compcor):
     """Filter according to acompcor mask(s) and select top components."""
     collector = []
     for mask in anat_mask:
-        cols = _json_mask(compcor_cols_filt, confounds_json, mask)
+        cols = _json_mask(acompcor_index, mask)
         cols = _select_compcor(cols, n_compcor)
         collector += cols
     return collector
 
 
-def _json_mask(compcor_cols_filt, confounds_json, mask):
+def _json_mask(acompcor_index, mask):
     """Extract anat compcor components from a given mask."""
-    cols = []
-    for compcor_col in compcor_cols_filt:
-        if confounds_json[compcor_col]["Mask"] in mask:
-            cols.append(compcor_col)
-    return cols
+    return [col for col, col_mask in acompcor_index if col_mask and col_mask in mask]
 
 
 def _prefix_confound_filter(prefix, all_compcor_name):
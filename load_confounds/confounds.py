@@ -4,20 +4,33 @@ Authors: load_confounds team
 """
 import numpy as np
 import pandas as pd
-from sklearn.decomposition import PCA
+from scipy import sparse
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.preprocessing import scale
 import os
 import json
 import re
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from .profiling import _stage
 
 
+# keywords of the indicators of outlier volumes, parsed as int8
+indicator_keywords = ["motion_outlier", "non_steady_state"]
+
 img_file_patterns = {
-    "aroma": "_desc-smoothAROMAnonaggr_bold",
-    "nii.gz": "_space-.*_desc-preproc_bold.nii.gz",
-    "dtseries.nii": "_space-.*_bold.dtseries.nii",
-    "func.gii": "_space-.*_hemi-[LR]_bold.func.gii",
+    "aroma": re.compile("_desc-smoothAROMAnonaggr_bold"),
+    "nii.gz": re.compile("_space-.*_desc-preproc_bold.nii.gz"),
+    "dtseries.nii": re.compile("_space-.*_bold.dtseries.nii"),
+    "func.gii": re.compile("_space-.*_hemi-[LR]_bold.func.gii"),
 }
 
+# fields of the compcor entries of the json data used to select components
+json_fields = ["Mask"]
+
 img_file_error = {
     "aroma": "Input must be ~desc-smoothAROMAnonaggr_bold for full ICA-AROMA strategy.",
     "nii.gz": "Invalid file type for the selected method.",
@@ -28,10 +41,7 @@ img_file_error = {
 
 def _check_params(confounds_raw, params):
     """Check that specified parameters can be found in the confounds."""
-    not_found_params = []
-    for par in params:
-        if not par in confounds_raw.columns:
-            not_found_params.append(par)
+    not_found_params = _header_index(confounds_raw.columns).missing(params)
     if not_found_params:
         raise MissingConfound(params=not_found_params)
     return None
@@ -39,9 +49,10 @@ def _check_params(confounds_raw, params):
 
 def _find_confounds(confounds_raw, keywords):
     """Find confounds that contain certain keywords."""
+    header = _header_index(confounds_raw.columns)
     list_confounds, missing_keys = [], []
     for key in keywords:
-        key_found = [col for col in confounds_raw.columns if key in col]
+        key_found = header.match(key)
         if key_found:
             list_confounds.extend(key_found)
         elif key != "non_steady_state":
@@ -81,10 +92,10 @@ def _add_suffix(params, model):
     """
     params_full = params.copy()
     suffix = {
-        "basic": {},
-        "derivatives": {"derivative1"},
-        "power2": {"power2"},
-        "full": {"derivative1", "power2", "derivative1_power2"},
+        "basic": [],
+        "derivatives": ["derivative1"],
+        "power2": ["power2"],
+        "full": ["derivative1", "power2", "derivative1_power2"],
     }
     for par in params:
         for suff in suffix[model]:
@@ -92,49 +103,85 @@ def _add_suffix(params, model):
     return params_full
 
 
-def _pca_motion(confounds_motion, n_components):
-    """Reduce the motion paramaters using PCA."""
+def _pca_motion(confounds_motion, n_components, pca=None):
+    """
+    Reduce the motion paramaters using PCA.
+    If `pca` is specified, the motion parameters are projected on its
+    components, e.g. fitted across runs with `_fit_motion_pca`.
+    """
     n_available = confounds_motion.shape[1]
     if n_components > n_available:
         raise ValueError(
             f"User requested n_motion={n_components} motion components, but found only {n_available}."
         )
+    index = confounds_motion.index
     confounds_motion = confounds_motion.dropna()
     confounds_motion_std = scale(
         confounds_motion, axis=0, with_mean=True, with_std=True
     )
-    pca = PCA(n_components=n_components)
-    motion_pca = pd.DataFrame(pca.fit_transform(confounds_motion_std))
+    if pca is None:
+        pca = PCA(n_components=n_components)
+        motion_pca = pca.fit_transform(confounds_motion_std)
+    else:
+        n_components = _n_motion_components(pca, n_components)
+        motion_pca = pca.transform(confounds_motion_std)[:, :n_components]
+    # keep the time points with NaN, so the components align with other confounds
+    motion_pca = pd.DataFrame(motion_pca, index=confounds_motion.index).reindex(index)
     motion_pca.columns = ["motion_pca_" + str(col + 1) for col in motion_pca.columns]
     return motion_pca
 
 
-def _optimize_scrub(fd_outliers, n_scans):
+def _n_motion_components(pca, n_components):
+    """Number of components to keep, or to exceed a ratio of explained variance."""
+    if 0 < n_components < 1:
+        ratio_cumsum = np.cumsum(pca.explained_variance_ratio_)
+        n_components = np.searchsorted(ratio_cumsum, n_components, side="right") + 1
+    return int(n_components)
+
+
+def _fit_motion_pca(runs_motion):
+    """
+    Fit a PCA of the motion parameters of several runs, with an incremental solver.
+    Each run is standardized separately, and the runs are streamed in one at a time.
+    Returns None if there are no motion parameters.
+    """
+    pca = IncrementalPCA()
+    batch = []
+    for confounds_motion in runs_motion:
+        batch.append(
+            scale(confounds_motion.dropna(), axis=0, with_mean=True, with_std=True)
+        )
+        # the first batch needs as many samples as parameters to get all components
+        n_samples = sum(len(run) for run in batch)
+        if hasattr(pca, "components_") or n_samples >= confounds_motion.shape[1]:
+            pca.partial_fit(np.concatenate(batch))
+            batch = []
+    if batch:
+        pca.partial_fit(np.concatenate(batch))
+    return pca if hasattr(pca, "components_") else None
+
+
+def _optimize_scrub(outliers, min_segment=5):
     """
     Perform optimized scrub. After scrub volumes, further remove
-    continuous segments containing fewer than 5 volumes.
+    continuous segments containing fewer than `min_segment` volumes.
     Power, Jonathan D., et al. "Methods to detect, characterize, and remove
     motion artifact in resting state fMRI." Neuroimage 84 (2014): 320-341.
+
+    `outliers` is a boolean mask of the scrubbed volumes, and an updated
+    mask is returned.
     """
-    # Start by checking if the beginning continuous segment is fewer than 5 volumes
-    if fd_outliers[0] < 5:
-        fd_outliers = np.asarray(list(range(fd_outliers[0])) + list(fd_outliers))
-    # Do the same for the ending segment of scans
-    if n_scans - (fd_outliers[-1] + 1) < 5:
-        fd_outliers = np.asarray(
-            list(fd_outliers) + list(range(fd_outliers[-1], n_scans))
-        )
-    # Now do everything in between
-    fd_outlier_ind_diffs = np.diff(fd_outliers)
-    short_segments_inds = np.where(
-        np.logical_and(fd_outlier_ind_diffs > 1, fd_outlier_ind_diffs < 6)
-    )[0]
-    for ind in short_segments_inds:
-        fd_outliers = np.asarray(
-            list(fd_outliers) + list(range(fd_outliers[ind] + 1, fd_outliers[ind + 1]))
-        )
-    fd_outliers = np.sort(np.unique(fd_outliers))
-    return fd_outliers
+    # run-length encoding of the segments of volumes which are kept
+    edges = np.diff(np.concatenate(([0], ~outliers, [0])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    short = (ends - starts) < min_segment
+    # mark the volumes of short segments, with the cumulative sum of
+    # +1 at the start and -1 at the end of each segment
+    delta = np.zeros(len(outliers) + 1, dtype=int)
+    delta[starts[short]] = 1
+    delta[ends[short]] -= 1
+    return outliers | (np.cumsum(delta[:-1]) > 0)
 
 
 def _get_file_raw(nii_file):
@@ -166,27 +213,38 @@ def _get_file_raw(nii_file):
         return confounds_raw[0]
 
 
+def _select_json(pairs):
+    """Keep the compcor entries of the json data, and their required fields."""
+    return {key: val for key, val in pairs if "_comp_cor" in key or key in json_fields}
+
+
 def _get_json(confounds_raw, flag_acompcor):
     """Load json data companion to the confounds tsv file."""
     # Load JSON file
     confounds_json = confounds_raw.replace("tsv", "json")
     try:
         with open(confounds_json, "rb") as f:
-            confounds_json = json.load(f)
+            # the entries are filtered while parsing, to save memory
+            confounds_json = json.load(f, object_pairs_hook=_select_json)
     except OSError:
-        if flag_acompcor:
-            raise ValueError(
-                f"Could not find a json file {confounds_json}. This is necessary for anat compcor"
-            )
+        pass
+    _check_json(confounds_json, flag_acompcor)
     return confounds_json
 
 
+def _check_json(confounds_json, flag_acompcor):
+    """Check the json data was found, if needed for anat compcor."""
+    # the json data is replaced by the path of the file if it could not be read
+    if flag_acompcor and isinstance(confounds_json, str):
+        raise ValueError(
+            f"Could not find a json file {confounds_json}. This is necessary for anat compcor"
+        )
+
+
 def _ext_validator(image_file, ext):
     """Check image is valid based on extention."""
     try:
-        valid_img = all(
-            bool(re.search(img_file_patterns[ext], img)) for img in image_file
-        )
+        valid_img = all(bool(img_file_patterns[ext].search(img)) for img in image_file)
         error_message = img_file_error[ext]
     except KeyError:
         valid_img = False
@@ -207,66 +265,595 @@ def _check_images(image_file, flag_full_aroma):
         raise ValueError(error_message)
 
 
-def _confounds_to_df(image_file, flag_acompcor, flag_full_aroma):
-    """Load raw confounds as a pandas DataFrame."""
-    _check_images(image_file, flag_full_aroma)
-    confounds_raw = _get_file_raw(image_file)
-    confounds_json = _get_json(confounds_raw, flag_acompcor)
-    confounds_raw = pd.read_csv(confounds_raw, delimiter="\t", encoding="utf-8")
-    return confounds_raw, confounds_json
+def _get_header(confounds_raw):
+    """Read the column names of a confounds tsv file."""
+    with open(confounds_raw, encoding="utf-8") as f:
+        header = f.readline()
+    return header.rstrip("\r\n").split("\t")
+
+
+class _HeaderIndex:
+    """
+    Column lookups in a confounds header.
+    Built once per distinct header, see `_header_index`.
+    """
+
+    def __init__(self, columns):
+        """Index the positions and prefix groups of the columns."""
+        self.columns = tuple(columns)
+        self.positions = {col: ind for ind, col in enumerate(self.columns)}
+        # group the columns by prefix, i.e. their name without trailing digits
+        # e.g. cosine00, cosine01... or a_comp_cor_00, a_comp_cor_01...
+        self.groups = {}
+        for col in self.columns:
+            self.groups.setdefault(col.rstrip("0123456789"), []).append(col)
+        self._matches = {}
+
+    def missing(self, params):
+        """Parameters which are not columns of the header."""
+        return [par for par in params if par not in self.positions]
+
+    def match(self, key):
+        """Columns containing a keyword, in header order."""
+        if key not in self._matches:
+            if any(char.isdigit() for char in key):
+                found = [col for col in self.columns if key in col]
+            else:
+                # a keyword without digits is in a column only if in its prefix
+                found = [
+                    col
+                    for prefix, group in self.groups.items()
+                    if key in prefix
+                    for col in group
+                ]
+                found.sort(key=self.positions.__getitem__)
+            self._matches[key] = found
+        return self._matches[key]
+
+    def select(self, params, keywords):
+        """Columns matching a parameter, or containing a keyword, in header order."""
+        selected = {par for par in params if par in self.positions}
+        for key in keywords:
+            selected.update(self.match(key))
+        return sorted(selected, key=self.positions.__getitem__)
+
+
+_header_indexes = OrderedDict()
+_header_indexes_size = 128
+
+
+def _header_index(columns):
+    """Get the index of a header, shared by all files with the same columns."""
+    columns = tuple(columns)
+    with _cache_lock:
+        index = _header_indexes.get(columns)
+        if index is not None:
+            _header_indexes.move_to_end(columns)
+            return index
+    index = _HeaderIndex(columns)
+    with _cache_lock:
+        _header_indexes[columns] = index
+        if len(_header_indexes) > _header_indexes_size:
+            _header_indexes.popitem(last=False)
+    return index
+
+
+def _select_columns(columns, params, keywords):
+    """Select columns matching a parameter, or containing a keyword."""
+    return _header_index(columns).select(params, keywords)
+
+
+def _cache_file(confounds_raw, cache_dir, dtype=None):
+    """Get the path of the binary cache of a confounds tsv file, parsed with a dtype."""
+    key = hashlib.sha1(os.path.abspath(confounds_raw).encode("utf-8")).hexdigest()
+    if dtype is not None:
+        key = f"{key}-{dtype}"
+    return os.path.join(cache_dir, f"{key}.npz")
+
+
+def _read_cache(cache_file, stat, usecols):
+    """
+    Read confounds from a binary cache.
+    Returns None if the cache is missing or out of date.
+    """
+    try:
+        with np.load(cache_file, allow_pickle=False) as cache:
+            if (cache["size"], cache["mtime"]) != stat:
+                return None
+            columns = {col: ind for ind, col in enumerate(cache["columns"].tolist())}
+            if usecols is None:
+                usecols = list(columns)
+            # each column is stored separately, only read the selected ones
+            return pd.DataFrame(
+                {col: cache[f"col{columns[col]}"] for col in usecols}, columns=usecols
+            )
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _write_cache(cache_file, stat, confounds):
+    """Write confounds to a binary cache, one array per column."""
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    arrays = {f"col{ind}": confounds[col].values for ind, col in enumerate(confounds)}
+    if any(array.dtype == object for array in arrays.values()):
+        return  # only numerical confounds can be cached
+    # write to a temporary file first, so concurrent loads never see a partial cache
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(
+                f,
+                columns=np.array(confounds.columns, dtype=str),
+                size=stat[0],
+                mtime=stat[1],
+                **arrays,
+            )
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _read_csv(confounds_raw, usecols=None, dtype=None):
+    """
+    Parse a confounds tsv file.
+    If `dtype` is specified, it is passed to the parser as a hint for each
+    column, so the confounds are not cast after parsing. The indicators of
+    outlier volumes are parsed as int8.
+    """
+    if dtype is None:
+        return pd.read_csv(
+            confounds_raw, delimiter="\t", encoding="utf-8", usecols=usecols
+        )
+    columns = _get_header(confounds_raw) if usecols is None else usecols
+    indicators = [
+        col for col in columns if any(key in col for key in indicator_keywords)
+    ]
+    dtypes = dict.fromkeys(columns, dtype)
+    dtypes.update(dict.fromkeys(indicators, np.int8))
+    try:
+        return pd.read_csv(
+            confounds_raw,
+            delimiter="\t",
+            encoding="utf-8",
+            usecols=usecols,
+            dtype=dtypes,
+        )
+    except ValueError:
+        if not indicators:
+            raise
+    # indicators with missing values cannot be parsed as integers
+    dtypes.update(dict.fromkeys(indicators, dtype))
+    return pd.read_csv(
+        confounds_raw, delimiter="\t", encoding="utf-8", usecols=usecols, dtype=dtypes
+    )
+
+
+def _read_tsv(
+    confounds_raw, usecols=None, cache_dir=None, record=None, dtype=None, stat=None
+):
+    """
+    Read a confounds tsv file.
+    If `cache_dir` is specified, a binary copy of the file is kept there, and
+    used as long as the size and modification time of the tsv do not change.
+    The `stat` of the tsv, as `_file_stat`, is read from the file if not specified.
+    If a profiling `record` is specified, the bytes read are added to it.
+    If `dtype` is specified, the confounds are parsed with it, see `_read_csv`.
+    """
+    if cache_dir is None:
+        confounds = _read_csv(confounds_raw, usecols, dtype)
+        if record is not None:
+            record["bytes"] += os.path.getsize(confounds_raw)
+        return confounds
+    if stat is None:
+        stat = os.stat(confounds_raw)
+        stat = stat.st_size, stat.st_mtime_ns
+    cache_file = _cache_file(confounds_raw, cache_dir, dtype)
+    confounds = _read_cache(cache_file, stat, usecols)
+    if confounds is None:
+        confounds = _read_csv(confounds_raw, dtype=dtype)
+        _write_cache(cache_file, stat, confounds)
+        if record is not None:
+            record["bytes"] += stat[0]
+        if usecols is not None:
+            confounds = confounds[usecols]
+    elif record is not None:
+        # only the arrays of the selected columns are read from the cache
+        record["bytes"] += int(confounds.memory_usage(index=False).sum())
+    return confounds
+
+
+# In-memory LRU cache of the raw confounds, indexed by tsv file and dtype.
+# Each entry holds the header, the json data and the columns parsed so far.
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_info = {"hits": 0, "misses": 0, "nbytes": 0, "max_nbytes": 256 * 2 ** 20}
+
+
+def clear_cache():
+    """Empty the in-memory cache of raw confounds and headers, and reset its counters."""
+    with _cache_lock:
+        _cache.clear()
+        _header_indexes.clear()
+        _cache_info.update(hits=0, misses=0, nbytes=0)
+
+
+def cache_info():
+    """
+    Statistics of the in-memory cache of raw confounds.
+
+    Returns
+    -------
+    info : dict
+        "hits" and "misses" count the lookups since the last `clear_cache`.
+        "nbytes" is the current size of the cache, and "max_nbytes" its budget.
+        "files" is the number of confounds files in the cache.
+    """
+    with _cache_lock:
+        return dict(_cache_info, files=len(_cache))
+
+
+def set_cache_size(max_nbytes):
+    """
+    Set the memory budget of the cache of raw confounds, in bytes.
+    The least recently used files are evicted to fit the budget.
+    0 disables the cache.
+    """
+    with _cache_lock:
+        _cache_info["max_nbytes"] = max_nbytes
+        _cache_evict()
+
+
+def _cache_evict():
+    """Drop least recently used entries until the cache fits in its budget."""
+    while _cache and _cache_info["nbytes"] > _cache_info["max_nbytes"]:
+        _, entry = _cache.popitem(last=False)
+        _cache_info["nbytes"] -= entry["nbytes"]
+
+
+def _file_stat(path):
+    """Size and modification time of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _freeze_json(confounds_json):
+    """Make a read-only view of json data."""
+    if isinstance(confounds_json, dict):
+        return MappingProxyType(
+            {key: _freeze_json(val) for key, val in confounds_json.items()}
+        )
+    if isinstance(confounds_json, list):
+        return tuple(_freeze_json(val) for val in confounds_json)
+    return confounds_json
+
+
+def _cache_get(key, stat):
+    """Get the cache entry of a confounds file, if it is up to date."""
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None or entry["stat"] != stat:
+            return None
+        _cache.move_to_end(key)
+        return entry
+
+
+def _cache_put(key, entry):
+    """Add an entry to the cache, within the memory budget."""
+    entry["nbytes"] = int(entry["confounds"].memory_usage(index=True).sum())
+    # the size of the json file is a proxy for the memory used by the json data
+    if entry["json"] is not None and entry["stat"][1] is not None:
+        entry["nbytes"] += entry["stat"][1][0]
+    with _cache_lock:
+        previous = _cache.pop(key, None)
+        if previous is not None:
+            _cache_info["nbytes"] -= previous["nbytes"]
+        if entry["nbytes"] <= _cache_info["max_nbytes"]:
+            _cache[key] = entry
+            _cache_info["nbytes"] += entry["nbytes"]
+            _cache_evict()
+
+
+def _cache_count(hit):
+    """Update the hit/miss counters of the cache."""
+    with _cache_lock:
+        _cache_info["hits" if hit else "misses"] += 1
+
+
+def _confounds_to_df(
+    image_file,
+    flag_acompcor,
+    flag_full_aroma,
+    find_columns=None,
+    cache_dir=None,
+    index=None,
+    load_json=True,
+    profile=None,
+    dtype=None,
+    json_files=None,
+):
+    """
+    Load raw confounds as a pandas DataFrame.
+    If `find_columns` is specified, it is called with the header of the tsv
+    file and the json data, and only the columns it returns are parsed.
+    The raw confounds are kept in an in-memory cache, see `set_cache_size`.
+    If a `DerivativesIndex` is specified, the confounds files and their
+    size and modification time are looked up in the index.
+    If `load_json` is False, the json file is not read, and None is returned
+    instead of the json data.
+    If a profile of the run is specified, the stages are recorded in it.
+    If `dtype` is specified, the confounds are parsed with it, see `_read_csv`.
+    If a list `json_files` is specified, the json file is appended to it when
+    it is read, rather than found in the cache.
+    """
+    with _stage(profile, "resolve"):
+        _check_images(image_file, flag_full_aroma)
+        if index is None:
+            confounds_raw = _get_file_raw(image_file)
+            file_stat = _file_stat
+        else:
+            confounds_raw = index.get_file_raw(image_file)
+            file_stat = index.stat
+        confounds_json = confounds_raw.replace("tsv", "json")
+        stat = (file_stat(confounds_raw), file_stat(confounds_json))
+    cache_key = (confounds_raw, dtype)
+    entry = _cache_get(cache_key, stat)
+    updated = entry is None
+    if entry is None:
+        with _stage(profile, "read_header") as record:
+            header = _get_header(confounds_raw)
+            if record is not None:
+                record["bytes"] = len("\t".join(header)) + 1
+        entry = {
+            "stat": stat,
+            "header": header,
+            "json": None,
+            "confounds": pd.DataFrame(),
+        }
+    if load_json and entry["json"] is None:
+        # do not try to open a json file known to be missing
+        if stat[1] is not None:
+            if json_files is not None:
+                json_files.append(confounds_json)
+            with _stage(profile, "read_json", stat[1][0]):
+                confounds_json = _get_json(confounds_raw, flag_acompcor)
+        entry = dict(entry, json=_freeze_json(confounds_json))
+        updated = True
+    confounds_json = entry["json"] if load_json else None
+    _check_json(confounds_json, flag_acompcor)
+    if find_columns is None:
+        usecols = entry["header"]
+    else:
+        with _stage(profile, "find_columns"):
+            usecols = find_columns(entry["header"], confounds_json)
+
+    cached_cols = set(entry["confounds"].columns)
+    hit = set(usecols) <= cached_cols
+    _cache_count(hit)
+    if not hit:
+        # parse the requested columns along with those already cached
+        usecols_all = [
+            col for col in entry["header"] if col in cached_cols or col in usecols
+        ]
+        with _stage(profile, "read_tsv") as record:
+            confounds = _read_tsv(
+                confounds_raw, usecols_all, cache_dir, record, dtype, stat[0]
+            )
+        entry = dict(entry, confounds=confounds)
+        updated = True
+    if updated and _cache_info["max_nbytes"] > 0:
+        _cache_put(cache_key, entry)
+    # indexing with a list of columns returns a copy,
+    # so the cached frame cannot be modified by the caller
+    return entry["confounds"][list(usecols)], confounds_json
 
 
 def _get_outlier_cols(confounds_columns):
     """Get outlier regressor column names."""
-    outlier_cols = {
-        col
-        for col in confounds_columns
-        if "motion_outlier" in col or "non_steady_state" in col
-    }
-    confounds_col = set(confounds_columns) - outlier_cols
+    header = _header_index(confounds_columns)
+    # lists rather than sets, so the order of the columns is preserved
+    outlier_cols = header.select([], ["motion_outlier", "non_steady_state"])
+    outliers = set(outlier_cols)
+    confounds_col = [col for col in header.columns if col not in outliers]
     return outlier_cols, confounds_col
 
 
-def _extract_outlier_regressors(confounds):
-    """Separate confounds and outlier regressors."""
-    outlier_cols, confounds_col = _get_outlier_cols(confounds.columns)
-    outliers = confounds[outlier_cols] if outlier_cols else pd.DataFrame()
-    confounds = confounds[confounds_col]
-    sample_mask = _outlier_to_sample_mask(outliers)
-    return sample_mask, confounds, outliers
-
-
 def _outlier_to_sample_mask(outlier_flag):
     """Generate sample mask from outlier regressors."""
     if outlier_flag.size == 0:  # Do not supply sample mask
         return None  # consistency with nilearn sample_mask
-    outlier_flag = outlier_flag.sum(axis=1).values
+    outlier_flag = np.asarray(outlier_flag).sum(axis=1)
     return np.where(outlier_flag == 0)[0].tolist()
 
 
-def _prepare_output(confounds, demean):
-    """Demean and create sample mask for the selected confounds."""
-    sample_mask, confounds, outliers = _extract_outlier_regressors(confounds)
+def outlier_regressors(sample_mask, n_scans, dense=False):
+    """
+    One-hot encoded regressors of the volumes excluded by a sample mask.
+
+    The excluded volumes include the motion outliers flagged by scrubbing,
+    and the non steady state volumes, if the strategy includes them.
+
+    Parameters
+    ----------
+    sample_mask : list of int or None
+        Index of the volumes preserved in the analysis, as returned by
+        `Confounds.load`.
+
+    n_scans : int
+        The number of volumes in the run.
+
+    dense : boolean, optional
+        If False (default), the regressors are a scipy.sparse matrix.
+        Otherwise, they are a numpy array of int8.
+
+    Returns
+    -------
+    regressors : scipy.sparse.csc_matrix or numpy.ndarray, shape (n_scans, n_outliers)
+        One column per excluded volume, equal to 1 at that volume and 0 elsewhere.
+
+    labels : list of str
+        The labels of the regressors, "excluded_volume_0", "excluded_volume_1", etc.
+    """
+    excluded = np.zeros(n_scans, dtype=bool)
+    if sample_mask is not None:
+        excluded[:] = True
+        excluded[sample_mask] = False
+    outliers = np.flatnonzero(excluded)
+    regressors = sparse.csc_matrix(
+        (np.ones(len(outliers), dtype=np.int8), (outliers, np.arange(len(outliers)))),
+        shape=(n_scans, len(outliers)),
+    )
+    if dense:
+        regressors = regressors.toarray()
+    labels = [f"excluded_volume_{num}" for num in range(len(outliers))]
+    return regressors, labels
+
+
+def _assemble_confounds(blocks, n_scans, dtype=np.float64):
+    """
+    Stack blocks of confounds in a single array of `dtype`, allocated once.
+    Outlier regressors are not copied in the array, and are only used to
+    generate the sample mask.
+    """
+    outliers, confounds_blocks = [], []
+    for block in blocks:
+        outlier_cols, confounds_col = _get_outlier_cols(block.columns)
+        if outlier_cols:
+            outliers.append(block[outlier_cols].to_numpy().sum(axis=1))
+            block = block[confounds_col]
+        if confounds_col:
+            confounds_blocks.append(block)
+    sample_mask = _outlier_to_sample_mask(np.transpose(outliers))
+
+    labels = tuple(col for block in confounds_blocks for col in block.columns)
+    confounds = np.empty((n_scans, len(labels)), dtype=dtype)
+    start = 0
+    for block in confounds_blocks:
+        confounds[:, start : start + block.shape[1]] = block.to_numpy()
+        start += block.shape[1]
+    return sample_mask, confounds, labels
+
+
+def _prepare_output(blocks, n_scans, demean, dtype=np.float64):
+    """
+    Assemble, demean and create sample mask for the selected confounds.
+    Returns the confounds as an array of `dtype`, along with their labels.
+    """
+    sample_mask, confounds, labels = _assemble_confounds(blocks, n_scans, dtype)
     if confounds.size != 0:  # ica_aroma = "full" generate empty output
         # Derivatives have NaN on the first row
         # Replace them by estimates at second time point,
         # otherwise nilearn will crash.
-        mask_nan = np.isnan(confounds.values[0, :])
-        confounds.iloc[0, mask_nan] = confounds.iloc[1, mask_nan]
+        mask_nan = np.isnan(confounds[0, :])
+        confounds[0, mask_nan] = confounds[1, mask_nan]
         if demean:
-            confounds = _demean_confounds(confounds, sample_mask)
-    return sample_mask, confounds
+            _demean_confounds(confounds, sample_mask)
+    return sample_mask, confounds, labels
 
 
 def _demean_confounds(confounds, sample_mask):
-    """Demean the confounds. The mean is calculated on non-outlier values."""
-    confound_cols = confounds.columns
-    if sample_mask is None:
-        confounds= scale(confounds, axis=0, with_std=False)
-    else:  # calculate the mean without outliers.
-        confounds_mean = confounds.iloc[sample_mask, :].mean(axis=0)
-        confounds -= confounds_mean
-    return pd.DataFrame(confounds, columns=confound_cols)
+    """
+    Demean the confounds array in place.
+    The mean is calculated on non-outlier values.
+    """
+    if np.isnan(confounds).any():
+        # missing values are ignored in the mean
+        if sample_mask is not None:
+            confounds_mean = np.nanmean(confounds[sample_mask, :], axis=0)
+        else:
+            confounds_mean = np.nanmean(confounds, axis=0)
+    else:
+        # weighted average over time, to avoid copying the non-outlier values
+        weights = np.zeros(confounds.shape[0])
+        if sample_mask is None:
+            weights[:] = 1 / confounds.shape[0]
+        elif len(sample_mask):
+            weights[sample_mask] = 1 / len(sample_mask)
+        else:  # all volumes are scrubbed, the mean is undefined
+            weights[:] = np.nan
+        confounds_mean = weights @ confounds
+    confounds -= confounds_mean
+    return confounds
+
+
+def _stack_batch(confounds, labels, sample_masks, pad=False):
+    """
+    Stack the assembled confounds of runs in a (runs x time x regressors) array.
+    The columns follow a layout shared by all runs. If `pad` is True, the
+    columns missing in a run are filled with zeros, otherwise runs with
+    different columns raise an error.
+    Returns the array and its labels, a boolean (runs x time) sample mask,
+    and a boolean (runs x regressors) mask of the valid columns of each run.
+    """
+    n_scans = sorted({conf.shape[0] for conf in confounds})
+    if len(n_scans) > 1:
+        raise ValueError(
+            f"All runs of a batch must have the same number of volumes. Got {n_scans}"
+        )
+    layout = tuple(dict.fromkeys(col for run_labels in labels for col in run_labels))
+    differ = [run for run, run_labels in enumerate(labels) if run_labels != layout]
+    if differ and not pad:
+        raise ValueError(
+            f"The confounds of runs {differ} do not have the columns {layout}. "
+            "Use pad=True to fill the missing columns with zeros."
+        )
+
+    positions = {col: ind for ind, col in enumerate(layout)}
+    batch = np.zeros(
+        (len(confounds), n_scans[0], len(layout)), np.result_type(*confounds)
+    )
+    valid = np.zeros((len(confounds), len(layout)), dtype=bool)
+    mask = np.ones((len(confounds), n_scans[0]), dtype=bool)
+    for run, (conf, run_labels, sample_mask) in enumerate(
+        zip(confounds, labels, sample_masks)
+    ):
+        cols = [positions[col] for col in run_labels]
+        batch[run][:, cols] = conf
+        valid[run, cols] = True
+        if sample_mask is not None:
+            mask[run] = False
+            mask[run, sample_mask] = True
+    return batch, layout, mask, valid
+
+
+def _prepare_batch(confounds, sample_mask, demean):
+    """
+    Fill NaN on the first volume, and demean a batch of confounds in place.
+    Each step is applied to all runs at once, see `_prepare_output`.
+    """
+    if confounds.size != 0:
+        mask_nan = np.isnan(confounds[:, 0, :])
+        np.copyto(confounds[:, 0, :], confounds[:, 1, :], where=mask_nan)
+        if demean:
+            _demean_batch(confounds, sample_mask)
+    return confounds
+
+
+def _demean_batch(confounds, sample_mask):
+    """
+    Demean a batch of confounds in place.
+    The mean of each run is calculated on non-outlier values.
+    """
+    if np.isnan(confounds).any():
+        # missing values are ignored in the mean
+        confounds_mean = np.nanmean(
+            np.where(sample_mask[:, :, np.newaxis], confounds, np.nan), axis=1
+        )
+    else:
+        n_samples = sample_mask.sum(axis=1, keepdims=True)
+        # the mean of runs where all volumes are scrubbed is undefined
+        weights = np.divide(
+            sample_mask,
+            n_samples,
+            out=np.full(sample_mask.shape, np.nan),
+            where=n_samples > 0,
+        )
+        confounds_mean = np.einsum("rt,rtk->rk", weights, confounds)
+    confounds -= confounds_mean[:, np.newaxis, :]
+    return confounds
 
 
 class MissingConfound(Exception):
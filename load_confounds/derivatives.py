@@ -0,0 +1,136 @@
+"""Index of the confounds files in a fMRIprep derivatives folder.
+
+Authors: load_confounds team
+"""
+import os
+import json
+
+
+# suffixes of the confounds files, before and after fMRIprep v20.2.0
+confounds_suffixes = [
+    "_desc-confounds_timeseries.tsv",
+    "_desc-confounds_regressors.tsv",
+]
+
+# suffixes of the processed images supported by load_confounds
+img_suffixes = ["_bold.nii.gz", "_bold.dtseries.nii", "_bold.func.gii"]
+
+
+def _img_prefix(img_file):
+    """Get the part of an image file name shared with its confounds files."""
+    if isinstance(img_file, list):  # catch gifti
+        img_file = img_file[0]
+    return os.path.abspath(img_file).split("_space-")[0]
+
+
+class DerivativesIndex:
+    """
+    Index of the confounds files in a fMRIprep derivatives folder.
+
+    The folder is scanned once, and the confounds files associated with
+    each processed image are then found through a dictionary lookup,
+    instead of checking for the existence of candidate files for each image.
+    The index can be saved to a json file, and passed to `Confounds.load`.
+
+    Parameters
+    ----------
+    root : path to a fMRIprep derivatives folder, optional
+        The folder is scanned recursively. If None, the index is empty.
+
+    Attributes
+    ----------
+    `img_files_` : list of str
+        The processed images found in the folder.
+
+    `confounds_` : dict
+        For each image prefix (the path of an image up to "_space-"),
+        the list of confounds tsv files found.
+
+    `stats_` : dict
+        The size and modification time of each confounds tsv and json file.
+    """
+
+    def __init__(self, root=None):
+        """Scan the derivatives folder."""
+        self.root = root
+        self.img_files_ = []
+        self.confounds_ = {}
+        self.stats_ = {}
+        if root is not None:
+            self._scan(root)
+
+    def _scan(self, root):
+        """Find all processed images and confounds files in a folder."""
+        for path, _, files in os.walk(os.path.abspath(root)):
+            for name in sorted(files):
+                file = os.path.join(path, name)
+                if any(name.endswith(suffix) for suffix in img_suffixes):
+                    self.img_files_.append(file)
+                for suffix in confounds_suffixes:
+                    if name.endswith(suffix):
+                        prefix = file[: -len(suffix)]
+                        self.confounds_.setdefault(prefix, []).append(file)
+                        self._add_stat(file)
+                        self._add_stat(file.replace("tsv", "json"))
+        self.img_files_.sort()
+
+    def _add_stat(self, file):
+        """Record the size and modification time of a file, if it exists."""
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return
+        self.stats_[file] = (stat.st_size, stat.st_mtime_ns)
+
+    def get_file_raw(self, img_file):
+        """Get the name of the raw confounds file associated with an image."""
+        confounds_raw = self.confounds_.get(_img_prefix(img_file), [])
+        if not confounds_raw:
+            raise ValueError("Could not find associated confound file.")
+        elif len(confounds_raw) != 1:
+            raise ValueError("Found more than one confound file.")
+        return confounds_raw[0]
+
+    def stat(self, file):
+        """Size and modification time of an indexed file, or None if it does not exist."""
+        return self.stats_.get(file)
+
+    def subset(self, img_files):
+        """Restrict the index to the confounds files of some images."""
+        index = DerivativesIndex()
+        index.root = self.root
+        for img_file in img_files:
+            prefix = _img_prefix(img_file)
+            if prefix not in self.confounds_:
+                continue
+            index.confounds_[prefix] = self.confounds_[prefix]
+            for confounds_raw in self.confounds_[prefix]:
+                for file in [confounds_raw, confounds_raw.replace("tsv", "json")]:
+                    if file in self.stats_:
+                        index.stats_[file] = self.stats_[file]
+        return index
+
+    def save(self, filename):
+        """Save the index to a json file."""
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "root": self.root,
+                    "img_files": self.img_files_,
+                    "confounds": self.confounds_,
+                    "stats": self.stats_,
+                },
+                f,
+            )
+
+    @classmethod
+    def from_file(cls, filename):
+        """Load an index saved with `save`."""
+        with open(filename, encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls()
+        index.root = data["root"]
+        index.img_files_ = data["img_files"]
+        index.confounds_ = data["confounds"]
+        index.stats_ = {file: tuple(stat) for file, stat in data["stats"].items()}
+        return index
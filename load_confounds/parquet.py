@@ -0,0 +1,197 @@
+"""Parquet datasets of confounds, partitioned by BIDS entities.
+
+Authors: load_confounds team
+"""
+import os
+import re
+import numpy as np
+import pandas as pd
+from . import confounds as cf
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency
+    pa = None
+
+# BIDS entities partitioning the datasets, in order
+bids_entities = ["sub", "ses", "task", "run", "space"]
+
+# partition of the runs without a given entity, read as a missing value
+missing_entity = "__HIVE_DEFAULT_PARTITION__"
+
+
+def _check_pyarrow():
+    """Check the optional dependency to pyarrow is installed."""
+    if pa is None:
+        raise ImportError(
+            "pyarrow is required for Parquet datasets. Install it with `pip install pyarrow`."
+        )
+
+
+def _get_entities(img_file):
+    """Get the BIDS entities of a run from the name of its image file."""
+    if isinstance(img_file, list):  # catch gifti
+        img_file = img_file[0]
+    entities = dict(
+        re.findall("(?:^|_)([a-zA-Z]+)-([a-zA-Z0-9]+)", os.path.basename(img_file))
+    )
+    return {entity: entities.get(entity) for entity in bids_entities}
+
+
+def _iter_raw(img_files, cache_dir=None, index=None):
+    """Load the raw confounds of runs, one at a time."""
+    for img_file in img_files:
+        confounds_raw, _ = cf._confounds_to_df(
+            img_file, False, False, cache_dir=cache_dir, index=index, load_json=False
+        )
+        yield img_file, confounds_raw.astype(np.float64)
+
+
+def _iter_reduced(strategy, img_files, cache_dir=None, index=None):
+    """Load the confounds of a strategy for runs, one at a time, with the sample mask."""
+    for img_file, confounds, labels, sample_mask in strategy.iter_load(
+        img_files, cache_dir, index, output="array"
+    ):
+        confounds = pd.DataFrame(confounds, columns=list(labels))
+        confounds["sample_mask"] = sample_mask is None
+        if sample_mask is not None:
+            confounds.loc[sample_mask, "sample_mask"] = True
+        yield img_file, confounds
+
+
+def export_parquet(path, img_files, strategy=None, cache_dir=None, index=None):
+    """
+    Write confounds in a Parquet dataset, partitioned by BIDS entities.
+
+    Each run is written in a separate file, in the folder of its
+    subject/session/task/run/space (e.g. `sub=01/ses=.../task=rest/run=1/space=...`).
+    Requires pyarrow.
+
+    Parameters
+    ----------
+    path : path to a directory
+        The root of the dataset, created if needed. Runs exported in
+        the same directory are added to the dataset.
+
+    img_files : path to processed image files, optionally as a list.
+        See `Confounds.load`. The entities are read from the file names.
+
+    strategy : Confounds, optional
+        If None (default), the raw confounds of fMRIprep are exported.
+        Otherwise, the confounds of the strategy are exported, along with a
+        boolean "sample_mask" column flagging the volumes to be preserved.
+
+    cache_dir : path to a directory, optional
+        Directory of the binary cache of the confounds files, see `Confounds.load`.
+
+    index : DerivativesIndex, optional
+        Index of the confounds files, see `Confounds.load`.
+    """
+    _check_pyarrow()
+    img_files, _ = cf._sanitize_confounds(img_files)
+    if strategy is None:
+        runs = _iter_raw(img_files, cache_dir, index)
+    else:
+        runs = _iter_reduced(strategy, img_files, cache_dir, index)
+
+    fields = {"volume": pa.field("volume", pa.int64())}
+    for img_file, confounds in runs:
+        table = pa.Table.from_pandas(confounds, preserve_index=False)
+        table = table.add_column(0, "volume", pa.array(np.arange(len(confounds))))
+        for field in table.schema:
+            fields.setdefault(field.name, field)
+        entities = _get_entities(img_file)
+        folder = os.path.join(
+            path,
+            *[
+                f"{entity}={entities[entity] or missing_entity}"
+                for entity in bids_entities
+            ],
+        )
+        os.makedirs(folder, exist_ok=True)
+        name = os.path.basename(img_file[0] if isinstance(img_file, list) else img_file)
+        pq.write_table(table, os.path.join(folder, name.split(".")[0] + ".parquet"))
+
+    # the schema of the dataset is the union of the columns of all runs
+    schema = pa.schema(
+        list(fields.values())
+        + [pa.field(entity, pa.string()) for entity in bids_entities]
+    )
+    schema_file = os.path.join(path, "_common_metadata")
+    if os.path.exists(schema_file):
+        schema = pa.unify_schemas([pq.read_schema(schema_file), schema])
+    pq.write_metadata(schema, schema_file)
+
+
+def _like_pattern(pattern):
+    """Convert a pattern with wildcards * and ? to a SQL LIKE pattern."""
+    pattern = re.sub(r"([%_\\])", r"\\\1", pattern)
+    return pattern.replace("*", "%").replace("?", "_")
+
+
+def _filter_expression(filters):
+    """Build a pyarrow expression from a dictionary of filters."""
+    if filters is None or isinstance(filters, pc.Expression):
+        return filters
+    expression = None
+    for name, value in filters.items():
+        field = ds.field(name)
+        if isinstance(value, (list, tuple, set)):
+            condition = field.isin(list(value))
+        elif isinstance(value, str) and ("*" in value or "?" in value):
+            condition = pc.match_like(field, _like_pattern(value))
+        else:
+            condition = field == value
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _open_dataset(path):
+    """Open a Parquet dataset, with the schema of all its runs."""
+    schema = pq.read_schema(os.path.join(path, "_common_metadata"))
+    return ds.dataset(path, format="parquet", partitioning="hive", schema=schema)
+
+
+def read_parquet(path, columns=None, filters=None):
+    """
+    Read confounds from a Parquet dataset written by `export_parquet`.
+
+    The filters are applied to the partitions first, so that only the files
+    of the selected runs are opened, and only the selected columns are read.
+    Requires pyarrow.
+
+    Parameters
+    ----------
+    path : path to a directory
+        The root of the dataset.
+
+    columns : list of str, optional
+        The confounds to read. Default is None: all columns.
+        The BIDS entities and the "volume" column are always included.
+
+    filters : dict or pyarrow.compute.Expression, optional
+        Selection of the rows to read. Each key of a dictionary is a column,
+        e.g. a BIDS entity, and the value is either a single value, a list of
+        values, or a pattern with wildcards "*" and "?".
+        For example, `{"task": "rest", "sub": "0*"}`.
+
+    Returns
+    -------
+    confounds : pandas.DataFrame
+        The confounds of the selected runs, one row per volume.
+    """
+    _check_pyarrow()
+    dataset = _open_dataset(path)
+    if columns is None:
+        columns = dataset.schema.names
+    missing = [col for col in columns if col not in dataset.schema.names]
+    if missing:
+        raise ValueError(f"The following columns are missing: {missing}")
+    # the entities and volumes come first
+    index_cols = bids_entities + ["volume"]
+    columns = index_cols + [col for col in columns if col not in index_cols]
+    table = dataset.to_table(columns=columns, filter=_filter_expression(filters))
+    return table.to_pandas()
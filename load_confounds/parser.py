@@ -2,10 +2,19 @@
 
 Authors: load_confounds team
 """
+import os
+import re
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from . import confounds as cf
+from .store import ConfoundsStore, write_store
 from .compcor import _find_compcor
+from .profiling import Profiler, _RunProfile, _stage, _summarize, _tracing
 
 # Global variables listing the admissible types of noise components
 all_confounds = [
@@ -19,6 +28,27 @@ all_confounds = [
     "non_steady_state",
 ]
 
+# Attributes controlling the selection of each type of noise components
+confound_attributes = {
+    "motion": ["motion", "n_motion", "motion_pca_scope"],
+    "high_pass": [],
+    "wm_csf": ["wm_csf"],
+    "global": ["global_signal"],
+    "compcor": ["compcor", "n_compcor", "acompcor_combined"],
+    "ica_aroma": ["ica_aroma"],
+    "scrub": ["scrub", "fd_thresh", "std_dvars_thresh"],
+    "non_steady_state": [],
+}
+
+# Basic head motion estimates
+motion_basic = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+
+# Groups of runs sharing a PCA of the motion parameters
+motion_pca_scopes = ["run", "subject", "dataset"]
+
+# supported dtypes of the confounds
+confounds_dtypes = ["float32", "float64"]
+
 
 def _sanitize_strategy(strategy):
     """Defines the supported denoising strategies."""
@@ -46,6 +76,160 @@ def _check_error(missing_confounds, missing_keys):
         raise ValueError(error_msg)
 
 
+def _check_motion_pca_scope(motion_pca_scope):
+    """Check the group of runs sharing a motion PCA is supported."""
+    if motion_pca_scope not in motion_pca_scopes:
+        raise ValueError(
+            f"motion_pca_scope must be one of {motion_pca_scopes}. Got {motion_pca_scope}"
+        )
+    return motion_pca_scope
+
+
+def _check_dtype(dtype):
+    """Check the dtype of the confounds is supported, and return its name."""
+    name = np.dtype(dtype).name
+    if name not in confounds_dtypes:
+        raise ValueError(f"dtype must be one of {confounds_dtypes}. Got {dtype}")
+    return name
+
+
+def _motion_pca_group(img_file, motion_pca_scope):
+    """Get the group of a run for the motion PCA: its subject, or the dataset."""
+    if motion_pca_scope == "dataset":
+        return "dataset"
+    if isinstance(img_file, list):  # catch gifti
+        img_file = img_file[0]
+    subject = re.search("sub-[a-zA-Z0-9]+", os.path.basename(img_file))
+    if subject is None:
+        raise ValueError(
+            f"The subject of {img_file} is unknown, its file name has no `sub-` "
+            "entity. Use motion_pca_scope 'run' or 'dataset' for such files."
+        )
+    return subject.group()
+
+
+def _check_output(output):
+    """Check the type of output is supported."""
+    if output not in ["dataframe", "array"]:
+        raise ValueError(f"output must be 'dataframe' or 'array'. Got {output}")
+
+
+def _to_dataframe(confounds, labels):
+    """Convert the confounds array of a run to a DataFrame."""
+    return pd.DataFrame(confounds, columns=list(labels))
+
+
+def _subset(index, img_file):
+    """Restrict an index to a single run, so it is cheap to send to a worker."""
+    return None if index is None else index.subset([img_file])
+
+
+def load_many(
+    strategies, img_files, n_jobs=1, cache_dir=None, index=None, output="dataframe"
+):
+    """
+    Load fMRIprep confounds for several strategies, parsing each run only once.
+
+    Parameters
+    ----------
+    strategies : list of Confounds
+        The denoising strategies, e.g. `[Minimal(), Scrubbing(), Confounds(...)]`.
+
+    img_files : path to processed image files, optionally as a list.
+        See `Confounds.load`. The strategies must accept the same image files,
+        e.g. `ICAAROMA` can only be combined with strategies using ICA-AROMA.
+
+    n_jobs : int, optional
+        The number of runs to load in parallel (default = 1).
+
+    cache_dir : path to a directory, optional
+        Directory of the binary cache of the confounds files, see `Confounds.load`.
+
+    index : DerivativesIndex, optional
+        Index of the confounds files, see `Confounds.load`.
+
+    output : string, optional
+        "dataframe" (default) or "array", see `Confounds.load`.
+
+    Returns
+    -------
+    outputs : list of tuples
+        For each strategy, the outputs of its `load` method.
+        The attributes of the strategies are also updated.
+    """
+    _check_output(output)
+    img_files, flag_single = cf._sanitize_confounds(img_files)
+    json_files = [[] for _ in strategies]
+    motion_pca = [
+        strategy._fit_motion_pca(img_files, cache_dir, index, files)
+        for strategy, files in zip(strategies, json_files)
+    ]
+    stateless = [strategy._stateless() for strategy in strategies]
+    outputs = Parallel(n_jobs=n_jobs)(
+        delayed(_load_many_single)(
+            stateless,
+            file,
+            cache_dir,
+            _subset(index, file),
+            [pca_runs[ind] for pca_runs, _ in motion_pca],
+        )
+        for ind, file in enumerate(img_files)
+    )
+    # outputs are organised by run, collect them by strategy
+    collected = []
+    for ind, strategy in enumerate(strategies):
+        strategy.motion_pca_ = motion_pca[ind][1]
+        collected.append(
+            strategy._collect(
+                [run[ind] for run in outputs],
+                flag_single,
+                output,
+                bool(json_files[ind]),
+            )
+        )
+    return collected
+
+
+def _load_many_single(strategies, img_file, cache_dir, index, motion_pca=None):
+    """Load a single confounds file for multiple strategies."""
+    flags = [strategy._flags() for strategy in strategies]
+    for _, flag_full_aroma in flags:
+        cf._check_images(img_file, flag_full_aroma)
+
+    def find_columns(columns, confounds_json):
+        """Find the columns needed by any of the strategies."""
+        needed = set()
+        for strategy, (flag_acompcor, _) in zip(strategies, flags):
+            cf._check_json(confounds_json, flag_acompcor)
+            needed.update(strategy._find_columns(columns, confounds_json))
+        return [col for col in columns if col in needed]
+
+    load_json = any(strategy._needs_json() for strategy in strategies)
+    json_files = []
+    # the confounds are parsed once, with the widest dtype of the strategies
+    dtypes = {strategy.dtype for strategy in strategies}
+    dtype = dtypes.pop() if len(dtypes) == 1 else "float64"
+    confounds_raw, confounds_json = cf._confounds_to_df(
+        img_file,
+        False,
+        flags[0][1],
+        find_columns,
+        cache_dir,
+        index,
+        load_json,
+        dtype=dtype,
+        json_files=json_files,
+    )
+    if motion_pca is None:
+        motion_pca = [None] * len(strategies)
+    memo = {}
+    return [
+        strategy._reduce(confounds_raw, confounds_json, memo, pca)
+        + (bool(json_files), None)
+        for strategy, pca in zip(strategies, motion_pca)
+    ]
+
+
 class Confounds:
     """
     Confounds from fmriprep
@@ -128,6 +312,35 @@ class Confounds:
         using nilearn with no or zscore standardization, but should be turned off
         with "spc" normalization.
 
+    profile : boolean or Profiler, optional
+        If True, the wall time, bytes read and peak memory allocation of each
+        stage of loading each run (e.g. reading the tsv file, scrubbing) are
+        recorded, and summarized in `profile_`. A `Profiler` can be passed to
+        trace memory allocations, or to hook into the records.
+        Default is False: no profiling. Predefined strategies are profiled by
+        setting the attribute, e.g. `strategy.profile = True`.
+        Runs loaded with `load_many` are not profiled.
+
+    dtype : string, optional
+        The dtype of the confounds, "float32" or "float64" (default).
+        The confounds files are parsed with this dtype, rather than cast
+        after parsing, and the indicators of outlier volumes are parsed as int8.
+        "float32" halves the memory of the confounds, e.g. for large batches
+        of runs. Predefined strategies use "float64", unless the attribute is
+        set, e.g. `strategy.dtype = "float32"`.
+
+    motion_pca_scope : string, optional
+        The runs sharing a principal component analysis of the motion parameters,
+        if `n_motion` is not 0.
+        "run" (default) a PCA is fitted for each run separately.
+        "subject" a PCA is fitted across the runs of each subject, identified by
+        the `sub-` entity of the file names. A file name without this entity
+        raises a ValueError.
+        "dataset" a PCA is fitted across all runs.
+        For "subject" and "dataset", the PCA is fitted incrementally, one run at a
+        time, and the motion parameters of each run are then projected on the
+        shared components.
+
 
     Attributes
     ----------
@@ -143,6 +356,25 @@ class Confounds:
             - Non-steady-state volumes (if present)
             - Motion outliers detected by scrubbing
 
+    `motion_pca_` : dict
+        The PCA of the motion parameters fitted across runs, for each subject
+        (e.g. "sub-01") or for the whole dataset ("dataset").
+        Empty if `motion_pca_scope` is "run".
+
+    `json_loaded_` : boolean
+        Whether json files companion to the confounds were read by the last
+        load. They are only read when the strategy includes "compcor", and
+        only the compcor entries are kept. Json data found in the in-memory
+        cache is not read again.
+
+    `profile_` : dict or None
+        Summary of the stages of the last call to `load`, `load_batch` or
+        `iter_load` (once exhausted), if `profile` is enabled, which can be
+        dumped to json. "time" and "bytes" are the totals of all runs,
+        "stages" aggregates the records of each stage (count, time,
+        mean_time, max_time, bytes and peak), and "runs" lists the totals
+        and stages of each run. See `Profiler` for the stages.
+
     Notes
     -----
     The predefined strategies implemented in this class are
@@ -161,6 +393,11 @@ class Confounds:
     https://doi.org/10.1016/j.neuroimage.2017.03.020
     """
 
+    # predefined strategies are not profiled and load float64 confounds,
+    # unless the attributes are set
+    profile = False
+    dtype = "float64"
+
     def __init__(
         self,
         strategy=["motion", "high_pass", "wm_csf"],
@@ -176,6 +413,9 @@ class Confounds:
         n_compcor="auto",
         ica_aroma=None,
         demean=True,
+        profile=False,
+        dtype="float64",
+        motion_pca_scope="run",
     ):
         """Default parameters."""
         self.strategy = _sanitize_strategy(strategy)
@@ -191,8 +431,11 @@ class Confounds:
         self.n_compcor = n_compcor
         self.ica_aroma = ica_aroma
         self.demean = demean
+        self.profile = profile
+        self.dtype = _check_dtype(dtype)
+        self.motion_pca_scope = _check_motion_pca_scope(motion_pca_scope)
 
-    def load(self, img_files):
+    def load(self, img_files, n_jobs=1, cache_dir=None, index=None, output="dataframe"):
         """
         Load fMRIprep confounds and sample mask
 
@@ -204,88 +447,613 @@ class Confounds:
             `func.gii`: list of a pair of paths to files, optionally as a list of lists.
             The companion tsv will be automatically detected.
 
+        n_jobs : int, optional
+            The number of runs to load in parallel (default = 1).
+            -1 means using all processors. The outputs are in the same
+            order as `img_files`, whatever the number of jobs.
+
+        cache_dir : path to a directory, optional
+            If specified, a binary copy of each confounds tsv file is stored in
+            this directory, and used instead of the tsv in subsequent loads.
+            A copy is refreshed when the size or modification time of
+            its tsv file changes. Default is None: no cache.
+
+        index : DerivativesIndex, optional
+            Index of the fMRIprep derivatives folder. If specified, the confounds
+            files are looked up in the index rather than on the file system.
+            The index should be rebuilt if the derivatives change.
+
+        output : string, optional
+            "dataframe" (default) returns the confounds as pandas.DataFrame.
+            "array" returns the confounds as C-contiguous numpy arrays of float,
+            along with the labels of the columns.
+
         Returns
         -------
         confounds :  pandas.DataFrame or list of pandas.DataFrame
             A reduced version of fMRIprep confounds based on selected strategy and flags.
             An intercept is automatically added to the list of confounds.
             The columns contains the labels of the regressors.
+            With `output="array"`, numpy.ndarray or list of numpy.ndarray.
+
+        labels : tuple of str or list of tuple of str
+            Only with `output="array"`. The labels of the confounds columns.
 
         sample_mask : list or list of list
             Index of time point to be preserved in the analysis
         """
-        return self._parse(img_files)
+        return self._parse(img_files, n_jobs, cache_dir, index, output)
+
+    async def aload(
+        self, img_files, concurrency=16, cache_dir=None, index=None, output="dataframe"
+    ):
+        """
+        Load fMRIprep confounds with asyncio, e.g. in a web service or a notebook.
+        The runs are loaded in a pool of threads, so that the lookups and reads
+        of the files of many runs overlap, which is faster on filesystems with
+        a high latency, and the event loop is not blocked while loading.
+
+        Parameters
+        ----------
+        img_files : path to processed image files, optionally as a list.
+            See `load`.
+
+        concurrency : int, optional
+            The maximal number of runs loaded at the same time (default = 16).
+
+        cache_dir : path to a directory, optional
+            Directory of the binary cache of the confounds files, see `load`.
+
+        index : DerivativesIndex, optional
+            Index of the confounds files, see `load`.
+
+        output : string, optional
+            "dataframe" (default) or "array", see `load`.
+
+        Returns
+        -------
+        The same outputs as `load`.
+        """
+        _check_output(output)
+        img_files, flag_single = cf._sanitize_confounds(img_files)
+        self._start_profile()
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        # memory allocations are traced once for all threads
+        memory = self._profiler is not None and self._profiler.memory
+        json_files = []
+        try:
+            with _tracing(memory):
+                motion_pca, self.motion_pca_ = await loop.run_in_executor(
+                    executor,
+                    self._fit_motion_pca,
+                    img_files,
+                    cache_dir,
+                    index,
+                    json_files,
+                )
+                runs = [
+                    loop.run_in_executor(
+                        executor, self._load_single, file, cache_dir, index, pca
+                    )
+                    for file, pca in zip(img_files, motion_pca)
+                ]
+                try:
+                    outputs = await asyncio.gather(*runs)
+                except BaseException:
+                    # gather does not cancel the other runs when one fails,
+                    # runs not started yet are cancelled in the pool
+                    for run in runs:
+                        run.cancel()
+                    raise
+        finally:
+            executor.shutdown(wait=False)
+        for *_, records in outputs:
+            self._add_profile(records)
+        self._end_profile()
+        return self._collect(outputs, flag_single, output, bool(json_files))
+
+    def load_batch(self, img_files, n_jobs=1, cache_dir=None, index=None, pad=False):
+        """
+        Load fMRIprep confounds of runs with the same number of volumes in a batch.
+        The confounds of all runs are stacked in a single array, and NaN filling
+        and demeaning are applied to all runs at once.
+
+        Parameters
+        ----------
+        img_files : path to processed image files, optionally as a list.
+            See `load`. All runs must have the same number of volumes.
+
+        n_jobs : int, optional
+            The number of runs to load in parallel (default = 1).
+
+        cache_dir : path to a directory, optional
+            Directory of the binary cache of the confounds files, see `load`.
+
+        index : DerivativesIndex, optional
+            Index of the confounds files, see `load`.
+
+        pad : boolean, optional
+            The confounds of all runs share the same columns. Runs can have
+            different columns, e.g. a different number of compcor components.
+            If True, the columns missing in a run are filled with zeros, and
+            flagged in `valid`. If False (default), such runs raise an error.
+
+        Returns
+        -------
+        confounds : numpy.ndarray
+            The confounds, with shape (runs, volumes, regressors).
+
+        labels : tuple of str
+            The labels of the regressors, shared by all runs.
+
+        sample_mask : numpy.ndarray
+            Boolean array of shape (runs, volumes), True for the volumes to be
+            preserved in the analysis.
+
+        valid : numpy.ndarray
+            Boolean array of shape (runs, regressors), False for the columns
+            padded with zeros.
+        """
+        img_files, _ = cf._sanitize_confounds(img_files)
+        self._start_profile()
+        outputs, json_loaded = self._load_all(
+            img_files, n_jobs, cache_dir, index, prepare=False
+        )
+        self._check_missing(outputs, json_loaded)
+        confounds, labels, sample_mask, valid = cf._stack_batch(
+            [conf for _, conf, *_ in outputs],
+            [labels for _, _, labels, *_ in outputs],
+            [sample_mask for sample_mask, *_ in outputs],
+            pad,
+        )
+        with self._profile_stage("batch", "prepare_batch"):
+            cf._prepare_batch(confounds, sample_mask, self.demean)
+        self._end_profile()
+        self.confounds_ = confounds
+        self.labels_ = labels
+        self.sample_mask_ = sample_mask
+        return confounds, labels, sample_mask, valid
+
+    def export(self, img_files, path, cache_dir=None, index=None):
+        """
+        Write the confounds of many runs in a memory-mapped store.
+        The runs are loaded one at a time, see `iter_load`. Reopening the
+        store with `ConfoundsStore` gives the confounds of each run as a view,
+        without parsing the confounds files again.
+
+        Parameters
+        ----------
+        img_files : path to processed image files, optionally as a list.
+            See `load`.
+
+        path : path to a directory
+            The directory of the store, created if needed.
+
+        cache_dir : path to a directory, optional
+            Directory of the binary cache of the confounds files, see `load`.
+
+        index : DerivativesIndex, optional
+            Index of the confounds files, see `load`.
+
+        Returns
+        -------
+        store : ConfoundsStore
+            The store, opened for reading.
+        """
+        write_store(path, self.iter_load(img_files, cache_dir, index, output="array"))
+        return ConfoundsStore(path)
+
+    def iter_load(self, img_files, cache_dir=None, index=None, output="dataframe"):
+        """
+        Load fMRIprep confounds and sample masks, one run at a time.
+        Unlike `load`, the outputs are not stored in the object, so that
+        very large collections of runs can be processed with constant memory.
+
+        Parameters
+        ----------
+        img_files : path to processed image files, optionally as a list.
+            See `load`. Any iterable of paths is accepted, e.g. a generator.
+
+        cache_dir : path to a directory, optional
+            Directory of the binary cache of the confounds files, see `load`.
+
+        index : DerivativesIndex, optional
+            Index of the confounds files, see `load`.
+
+        output : string, optional
+            "dataframe" (default) or "array", see `load`.
+
+        Yields
+        ------
+        img_file : str or list of str
+            The path to the processed image file(s) of the run.
+
+        confounds : pandas.DataFrame or numpy.ndarray
+            The reduced confounds of the run, see `load`.
+
+        labels : tuple of str
+            Only with `output="array"`. The labels of the confounds columns.
+
+        sample_mask : list
+            Index of time point to be preserved in the analysis of the run.
+        """
+        _check_output(output)
+        img_files, _ = cf._sanitize_confounds(img_files)
+        self._start_profile()
+        if self._motion_pca_shared():
+            # a first pass over the runs is required to fit the motion PCA
+            img_files = list(img_files)
+            motion_pca, _ = self._fit_motion_pca(img_files, cache_dir, index)
+        else:
+            motion_pca = itertools.repeat(None)
+        for img_file, pca in zip(img_files, motion_pca):
+            sample_mask, confounds, labels, missing, _, records = self._load_single(
+                img_file, cache_dir, index, pca
+            )
+            _check_error(missing.params, missing.keywords)
+            self._add_profile(records)
+            if output == "array":
+                yield img_file, confounds, labels, sample_mask
+            else:
+                yield img_file, _to_dataframe(confounds, labels), sample_mask
+        self._end_profile()
 
-    def _parse(self, img_files):
+    def _parse(
+        self, img_files, n_jobs=1, cache_dir=None, index=None, output="dataframe"
+    ):
         """Parse input image, find confound files and scrubbing etc."""
+        _check_output(output)
         img_files, flag_single = cf._sanitize_confounds(img_files)
 
-        confounds_out = []
-        sample_mask_out = []
+        self._start_profile()
+        outputs, json_loaded = self._load_all(img_files, n_jobs, cache_dir, index)
+        self._end_profile()
+        return self._collect(outputs, flag_single, output, json_loaded)
+
+    def _load_all(self, img_files, n_jobs=1, cache_dir=None, index=None, prepare=True):
+        """
+        Load all runs, in parallel.
+        Also returns whether json files were read to fit a shared motion PCA.
+        """
+        json_files = []
+        motion_pca, self.motion_pca_ = self._fit_motion_pca(
+            img_files, cache_dir, index, json_files
+        )
+        stateless = self._stateless()
+        # joblib preserves the order of the inputs
+        outputs = Parallel(n_jobs=n_jobs)(
+            delayed(stateless._load_single)(
+                file, cache_dir, _subset(index, file), pca, prepare
+            )
+            for file, pca in zip(img_files, motion_pca)
+        )
+        for *_, records in outputs:
+            self._add_profile(records)
+        return outputs, bool(json_files)
+
+    def _check_missing(self, outputs, json_loaded=False):
+        """
+        Check for missing confounds in the outputs of all runs, and whether
+        their json files were read (`json_loaded` if read outside of the runs).
+        """
         self.missing_confounds_ = []
         self.missing_keys_ = []
+        self.json_loaded_ = json_loaded
+        for *_, missing, json_loaded, _ in outputs:
+            self.json_loaded_ = self.json_loaded_ or json_loaded
+            self.missing_confounds_ += [
+                par for par in missing.params if par not in self.missing_confounds_
+            ]
+            self.missing_keys_ += [
+                key for key in missing.keywords if key not in self.missing_keys_
+            ]
+        _check_error(self.missing_confounds_, self.missing_keys_)
 
-        for file in img_files:
-            sample_mask, conf = self._load_single(file)
-            confounds_out.append(conf)
-            sample_mask_out.append(sample_mask)
+    def _collect(self, outputs, flag_single, output="dataframe", json_loaded=False):
+        """Gather the outputs of all runs, and check for missing confounds."""
+        self._check_missing(outputs, json_loaded)
+        confounds_out = [conf for _, conf, *_ in outputs]
+        labels_out = [labels for _, _, labels, *_ in outputs]
+        sample_mask_out = [sample_mask for sample_mask, *_ in outputs]
+
+        if output == "dataframe":
+            confounds_out = [
+                _to_dataframe(conf, labels)
+                for conf, labels in zip(confounds_out, labels_out)
+            ]
 
         # If a single input was provided,
         # send back a single output instead of a list
         if flag_single:
             confounds_out = confounds_out[0]
+            labels_out = labels_out[0]
             sample_mask_out = sample_mask_out[0]
 
         self.confounds_ = confounds_out
         self.sample_mask_ = sample_mask_out
+        if output == "array":
+            self.labels_ = labels_out
+            return confounds_out, labels_out, sample_mask_out
         return confounds_out, sample_mask_out
 
-
-    def _load_single(self, confounds_raw):
-        """Load a single confounds file from fmriprep."""
-        # Convert tsv file to pandas dataframe
-        # check if relevant imaging files are present according to the strategy
+    def _flags(self):
+        """Check if the strategy requires the json file, or the ICA-AROMA image."""
         flag_acompcor = ("compcor" in self.strategy) and (self.compcor == "anat")
         flag_full_aroma = ("ica_aroma" in self.strategy) and (self.ica_aroma == "full")
-        confounds_raw, self.json_ = cf._confounds_to_df(
-            confounds_raw, flag_acompcor, flag_full_aroma
+        return flag_acompcor, flag_full_aroma
+
+    def _needs_json(self):
+        """Check if the strategy uses the json file, i.e. to select compcor components."""
+        return "compcor" in self.strategy
+
+    def _motion_pca_shared(self):
+        """Check if the motion PCA is fitted across runs."""
+        return (
+            "motion" in self.strategy
+            and self.n_motion > 0
+            and self.motion_pca_scope != "run"
         )
 
-        confounds = pd.DataFrame()
+    def _stateless(self):
+        """
+        Copy of the strategy without the outputs of previous loads, nor the
+        records of its profiler, so it is cheap to send to workers.
+        """
+        stateless = object.__new__(type(self))
+        stateless.__dict__ = {
+            key: value
+            for key, value in self.__dict__.items()
+            if not key.endswith("_") and key not in ["_profiler", "_profile_records"]
+        }
+        if self.profile:
+            # workers only need to know if, and how, runs are profiled
+            stateless.profile = Profiler(getattr(self.profile, "memory", False))
+        return stateless
 
-        for confound in self.strategy:
-            loaded_confounds = self._load_confound(confounds_raw, confound)
-            confounds = pd.concat([confounds, loaded_confounds], axis=1)
+    def _start_profile(self):
+        """Start collecting the records of the stages, if profiling is enabled."""
+        self._profiler = None
+        if isinstance(self.profile, Profiler):
+            self._profiler = self.profile
+        elif self.profile:
+            self._profiler = Profiler()
+        self._profile_records = []
 
-        _check_error(self.missing_confounds_, self.missing_keys_)
-        sample_mask, confounds= cf._prepare_output(
-            confounds, self.demean
-        )
-        return sample_mask, confounds
+    def _add_profile(self, records):
+        """Pass the records of a run to the profiler."""
+        if getattr(self, "_profiler", None) is None or records is None:
+            return
+        for record in records:
+            self._profiler.add(record)
+        self._profile_records.extend(records)
+
+    def _end_profile(self):
+        """Summarize the records of the stages in `profile_`."""
+        self.profile_ = None
+        if self._profiler is not None:
+            self.profile_ = _summarize(self._profile_records)
+        self._profile_records = []
+
+    @contextmanager
+    def _profile_stage(self, run, name):
+        """Record a stage outside of loading a single run, e.g. across runs."""
+        if getattr(self, "_profiler", None) is None:
+            yield
+            return
+        profile = _RunProfile(run, self._profiler.memory)
+        try:
+            with profile.stage(name):
+                yield
+        finally:
+            self._add_profile(profile.close())
+
+    def _fit_motion_pca(self, img_files, cache_dir=None, index=None, json_files=None):
+        """
+        Fit the motion PCA shared by the runs of each subject, or of the dataset.
+        The raw confounds of the runs are loaded one at a time, and the json
+        files read are appended to `json_files`, if specified.
+        Returns the PCA of each run (None for a PCA per run), and the PCA of each group.
+        """
+        if not self._motion_pca_shared():
+            return [None] * len(img_files), {}
+        groups = [
+            _motion_pca_group(img_file, self.motion_pca_scope) for img_file in img_files
+        ]
+        runs = {}
+        for img_file, group in zip(img_files, groups):
+            runs.setdefault(group, []).append(img_file)
+        motion_pca = {}
+        for group, group_files in runs.items():
+            with self._profile_stage(group, "fit_motion_pca"):
+                motion_pca[group] = cf._fit_motion_pca(
+                    self._iter_motion(group_files, cache_dir, index, json_files)
+                )
+        return [motion_pca[group] for group in groups], motion_pca
 
-    def _load_confound(self, confounds_raw, confound):
-        """Load a single type of confound."""
+    def _iter_motion(self, img_files, cache_dir=None, index=None, json_files=None):
+        """Load the motion parameters of runs, one at a time."""
+        motion_params = cf._add_suffix(motion_basic, self.motion)
+        flag_acompcor, flag_full_aroma = self._flags()
+        for img_file in img_files:
+            # the columns of the strategy are parsed, so the raw confounds
+            # can be reused from the cache when the runs are loaded
+            confounds_raw, _ = cf._confounds_to_df(
+                img_file,
+                flag_acompcor,
+                flag_full_aroma,
+                self._find_columns,
+                cache_dir,
+                index,
+                self._needs_json(),
+                dtype=self.dtype,
+                json_files=json_files,
+            )
+            try:
+                cf._check_params(confounds_raw, motion_params)
+            except cf.MissingConfound:
+                continue  # reported when the run is loaded
+            yield confounds_raw[motion_params]
+
+    def _load_single(
+        self, img_file, cache_dir=None, index=None, motion_pca=None, prepare=True
+    ):
+        """
+        Load a single confounds file from fmriprep.
+        The instance is not modified, so that runs can be loaded in parallel.
+        `motion_pca` is an optional PCA of motion parameters fitted across runs.
+        If profiling is enabled, the records of the stages are returned last.
+        """
+        profile = None
+        if self.profile:
+            profile = _RunProfile(img_file, getattr(self.profile, "memory", False))
         try:
-            loaded_confounds = getattr(self, f"_load_{confound}")(confounds_raw)
-        except cf.MissingConfound as exception:
-            self.missing_confounds_ += exception.params
-            self.missing_keys_ += exception.keywords
-            loaded_confounds = pd.DataFrame()
+            # Convert tsv file to pandas dataframe
+            # check if relevant imaging files are present according to the strategy
+            flag_acompcor, flag_full_aroma = self._flags()
+            json_files = []
+            confounds_raw, confounds_json = cf._confounds_to_df(
+                img_file,
+                flag_acompcor,
+                flag_full_aroma,
+                self._find_columns,
+                cache_dir,
+                index,
+                self._needs_json(),
+                profile,
+                self.dtype,
+                json_files,
+            )
+            outputs = self._reduce(
+                confounds_raw, confounds_json, None, motion_pca, prepare, profile
+            )
+        finally:
+            records = None if profile is None else profile.close()
+        return outputs + (bool(json_files), records)
+
+    def _reduce(
+        self,
+        confounds_raw,
+        confounds_json,
+        memo=None,
+        motion_pca=None,
+        prepare=True,
+        profile=None,
+    ):
+        """
+        Select the confounds of the strategy from the raw confounds of a run.
+        `memo` is an optional dictionary of confounds already selected for
+        this run, shared across strategies.
+        `motion_pca` is an optional PCA of motion parameters fitted across runs.
+        The confounds are returned as an array of `dtype`, along with their labels.
+        If `prepare` is False, NaN are not filled and the confounds are not
+        demeaned, e.g. to prepare a batch of runs at once.
+        If a profile of the run is specified, the stages are recorded in it.
+        """
+        blocks = []
+        missing = cf.MissingConfound()
+
+        for confound in self.strategy:
+            with _stage(profile, f"load_{confound}"):
+                loaded_confounds = self._load_confound(
+                    confounds_raw,
+                    confounds_json,
+                    confound,
+                    missing,
+                    memo,
+                    motion_pca,
+                    profile,
+                )
+            if loaded_confounds.shape[1] > 0:
+                blocks.append(loaded_confounds)
+
+        if missing.params or missing.keywords:
+            return None, None, None, missing
+        if prepare:
+            with _stage(profile, "prepare"):
+                sample_mask, confounds, labels = cf._prepare_output(
+                    blocks, len(confounds_raw), self.demean, self.dtype
+                )
+        else:
+            sample_mask, confounds, labels = cf._assemble_confounds(
+                blocks, len(confounds_raw), self.dtype
+            )
+        return sample_mask, confounds, labels, missing
+
+    def _find_columns(self, columns, confounds_json):
+        """Find the columns of the raw confounds needed by the strategy."""
+        params, keywords = [], []
+        if "motion" in self.strategy:
+            params += cf._add_suffix(motion_basic, self.motion)
+        if "high_pass" in self.strategy:
+            keywords.append("cosine")
+        if "wm_csf" in self.strategy:
+            params += cf._add_suffix(["csf", "white_matter"], self.wm_csf)
+        if "global" in self.strategy:
+            params += cf._add_suffix(["global_signal"], self.global_signal)
+        if "compcor" in self.strategy:
+            params += _find_compcor(
+                confounds_json, self.compcor, self.n_compcor, self.acompcor_combined
+            )
+        if "ica_aroma" in self.strategy and self.ica_aroma == "basic":
+            keywords.append("aroma")
+        if "scrub" in self.strategy:
+            params += ["framewise_displacement", "std_dvars"]
+        if "non_steady_state" in self.strategy:
+            keywords.append("non_steady_state")
+        return cf._select_columns(columns, params, keywords)
+
+    def _load_confound(
+        self,
+        confounds_raw,
+        confounds_json,
+        confound,
+        missing,
+        memo=None,
+        motion_pca=None,
+        profile=None,
+    ):
+        """
+        Load a single type of confound.
+        Missing parameters and keywords are collected in `missing`.
+        """
+        key = (confound,) + tuple(
+            getattr(self, attr) for attr in confound_attributes[confound]
+        )
+        if memo is not None and key in memo:
+            loaded_confounds, params, keywords = memo[key]
+        else:
+            params, keywords = [], []
+            try:
+                if confound == "compcor":
+                    loaded_confounds = self._load_compcor(confounds_raw, confounds_json)
+                elif confound == "motion":
+                    loaded_confounds = self._load_motion(
+                        confounds_raw, motion_pca, profile
+                    )
+                else:
+                    loaded_confounds = getattr(self, f"_load_{confound}")(confounds_raw)
+            except cf.MissingConfound as exception:
+                params, keywords = exception.params, exception.keywords
+                loaded_confounds = pd.DataFrame()
+            if memo is not None:
+                memo[key] = (loaded_confounds, params, keywords)
+        missing.params += params
+        missing.keywords += keywords
         return loaded_confounds
 
-    def _load_motion(self, confounds_raw):
+    def _load_motion(self, confounds_raw, motion_pca=None, profile=None):
         """Load the motion regressors."""
-        motion_params = cf._add_suffix(
-            ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"], self.motion
-        )
+        motion_params = cf._add_suffix(motion_basic, self.motion)
         cf._check_params(confounds_raw, motion_params)
         confounds_motion = confounds_raw[motion_params]
 
         # Optionally apply PCA reduction
         if self.n_motion > 0:
-            confounds_motion = cf._pca_motion(
-                confounds_motion, n_components=self.n_motion
-            )
+            with _stage(profile, "pca"):
+                confounds_motion = cf._pca_motion(
+                    confounds_motion, n_components=self.n_motion, pca=motion_pca
+                )
         return confounds_motion
 
     def _load_high_pass(self, confounds_raw):
@@ -305,10 +1073,10 @@ class Confounds:
         cf._check_params(confounds_raw, global_params)
         return confounds_raw[global_params]
 
-    def _load_compcor(self, confounds_raw):
+    def _load_compcor(self, confounds_raw, confounds_json):
         """Load compcor regressors."""
         compcor_cols = _find_compcor(
-            self.json_, self.compcor, self.n_compcor, self.acompcor_combined
+            confounds_json, self.compcor, self.n_compcor, self.acompcor_combined
         )
         cf._check_params(confounds_raw, compcor_cols)
         return confounds_raw[compcor_cols]
@@ -325,28 +1093,19 @@ class Confounds:
 
     def _load_scrub(self, confounds_raw):
         """Perform basic scrub - Remove volumes if framewise displacement exceeds threshold."""
-        n_scans = len(confounds_raw)
-        # Get indices of fd outliers
-        fd_outliers = np.where(
-            confounds_raw["framewise_displacement"] > self.fd_thresh
-        )[0]
-        dvars_outliers = np.where(confounds_raw["std_dvars"] > self.std_dvars_thresh)[0]
-        combined_outliers = np.sort(
-            np.unique(np.concatenate((fd_outliers, dvars_outliers)))
-        )
+        # Flag fd and dvars outliers
+        motion_outliers = (
+            confounds_raw["framewise_displacement"].to_numpy() > self.fd_thresh
+        ) | (confounds_raw["std_dvars"].to_numpy() > self.std_dvars_thresh)
         # Do full scrubbing if desired, and motion outliers were detected
-        if self.scrub == "full" and len(combined_outliers) > 0:
-            combined_outliers = cf._optimize_scrub(combined_outliers, n_scans)
-        # Make one-hot encoded motion outlier regressors
-        motion_outlier_regressors = pd.DataFrame(
-            np.transpose(np.eye(n_scans)[combined_outliers]).astype(int)
-        )
-        column_names = [
-            "motion_outlier_" + str(num)
-            for num in range(np.shape(motion_outlier_regressors)[1])
-        ]
-        motion_outlier_regressors.columns = column_names
-        return motion_outlier_regressors
+        if self.scrub == "full" and motion_outliers.any():
+            motion_outliers = cf._optimize_scrub(motion_outliers)
+        # without outliers, no sample mask is generated from scrubbing
+        if not motion_outliers.any():
+            return pd.DataFrame()
+        # Flag motion outliers in a single column, the sample mask is generated
+        # from it, see `outlier_regressors` for one-hot encoded regressors
+        return pd.DataFrame({"motion_outlier": motion_outliers.astype(np.int8)})
 
     def _load_non_steady_state(self, confounds_raw):
         """Find non steady state regressors."""
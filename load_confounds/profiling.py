@@ -0,0 +1,186 @@
+"""Instrumentation of the stages of loading confounds.
+
+Authors: load_confounds team
+"""
+import time
+import json
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# the peaks of nested stages need to reset the peak of tracemalloc,
+# available from python 3.9
+_trace_peaks = hasattr(tracemalloc, "reset_peak")
+
+
+class _RunProfile:
+    """
+    Records of the stages of loading a run.
+    Created for each run when profiling is enabled, and sent back with the
+    outputs of the run, so that runs can be profiled in worker processes.
+    """
+
+    def __init__(self, run, memory=False):
+        """Start profiling a run."""
+        self.run = run
+        self.records = []
+        self._memory = memory and _trace_peaks
+        self._tracing = self._memory and not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+        # the run is the outermost stage
+        self._stack = []
+        self._start = self._enter()
+
+    def _enter(self):
+        """Start measuring time and memory allocations."""
+        if self._memory:
+            # the peak of an outer stage includes the peaks of nested stages,
+            # which reset the peak of tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            self._stack.append({"start": current, "peak": current})
+        return time.perf_counter()
+
+    def _exit(self, record, start):
+        """Record the time and peak memory allocation since `_enter`."""
+        record["time"] = time.perf_counter() - start
+        if self._memory:
+            entry = self._stack.pop()
+            peak = max(tracemalloc.get_traced_memory()[1], entry["peak"])
+            record["peak"] = peak - entry["start"]
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+        self.records.append(record)
+
+    def close(self):
+        """
+        Record the total of the run, and stop tracing memory allocations
+        if started for this run.
+        """
+        nbytes = sum(record["bytes"] for record in self.records)
+        record = {"run": self.run, "stage": "total", "bytes": nbytes, "peak": None}
+        self._exit(record, self._start)
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        return self.records
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        """
+        Record the wall time, bytes read and peak memory allocation of a stage.
+        Yields the record, so the bytes read can be updated within the stage.
+        """
+        record = {"run": self.run, "stage": name, "bytes": nbytes, "peak": None}
+        start = self._enter()
+        try:
+            yield record
+        finally:
+            self._exit(record, start)
+
+
+def _stage(profile, name, nbytes=0):
+    """
+    Record a stage of a run, if it is profiled.
+    Yields the record of the stage, or None if the run is not profiled.
+    """
+    if profile is None:
+        return nullcontext()
+    return profile.stage(name, nbytes)
+
+
+@contextmanager
+def _tracing(memory=True):
+    """Trace memory allocations within the context, if not already traced."""
+    started = memory and _trace_peaks and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if started:
+            tracemalloc.stop()
+
+
+class Profiler:
+    """
+    Collector of the records of the stages of loading confounds.
+
+    Each stage of loading each run is recorded as a dictionary with keys
+    "run" (the image file), "stage", "time" (wall time in seconds),
+    "bytes" (bytes read from disk) and "peak" (peak memory allocated in
+    bytes, or None if memory is not traced). The stages are:
+    "resolve" finding the confounds files,
+    "read_header", "read_json" and "read_tsv" reading the confounds files,
+    "find_columns" selecting the columns to parse,
+    "load_<confound>" selecting each type of confounds (e.g. "load_scrub"),
+    "pca" the PCA of the motion parameters, within "load_motion",
+    "prepare" assembling and demeaning the confounds,
+    and "total" the whole run, recorded last.
+    Loading many runs also records "fit_motion_pca" (for a PCA shared across
+    runs, with the group as "run") and "prepare_batch" (see `Confounds.load_batch`).
+
+    Pass a profiler as the `profile` parameter of `Confounds`. To hook into the
+    records, e.g. to log slow stages, subclass `Profiler` and override `add`.
+
+    Parameters
+    ----------
+    memory : boolean, optional
+        If True, the peak memory allocated by each stage is traced with
+        tracemalloc, which slows down loading. Peaks are only accurate when
+        runs are not loaded by concurrent threads. Peaks require python 3.9
+        or later, and are None with older versions.
+
+    Attributes
+    ----------
+    `records_` : list of dict
+        All the records collected by the profiler.
+    """
+
+    def __init__(self, memory=False):
+        """Start with no records."""
+        self.memory = memory
+        self.records_ = []
+
+    def add(self, record):
+        """Collect the record of a stage. Called once the run is loaded."""
+        self.records_.append(record)
+
+
+def _summarize(records):
+    """
+    Aggregate records, by stage and by run.
+    Returns a dictionary, which can be dumped to json.
+    """
+    stages, runs = {}, {}
+    for record in records:
+        key = json.dumps(record["run"])  # gifti runs are lists
+        run = runs.setdefault(key, {"run": record["run"], "stages": {}})
+        if record["stage"] == "total":
+            run.update(time=record["time"], bytes=record["bytes"], peak=record["peak"])
+            continue
+        _accumulate(run["stages"].setdefault(record["stage"], {}), record)
+        _accumulate(stages.setdefault(record["stage"], {}), record)
+    for stage in stages.values():
+        stage["mean_time"] = stage["time"] / stage["count"]
+    runs = list(runs.values())
+    return {
+        "time": sum(run.get("time", 0.0) for run in runs),
+        "bytes": sum(run.get("bytes", 0) for run in runs),
+        "stages": stages,
+        "runs": runs,
+    }
+
+
+def _accumulate(stats, record):
+    """Add a record to the statistics of a stage."""
+    if not stats:
+        stats.update(count=0, time=0.0, max_time=0.0, bytes=0, peak=None)
+    stats["count"] += 1
+    stats["time"] += record["time"]
+    stats["max_time"] = max(stats["max_time"], record["time"])
+    stats["bytes"] += record["bytes"]
+    if record["peak"] is not None:
+        stats["peak"] = max(stats["peak"] or 0, record["peak"])
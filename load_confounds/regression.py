@@ -0,0 +1,280 @@
+"""Regression of confounds out of time series.
+
+Authors: load_confounds team
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy import linalg
+
+# LRU cache of the projectors on the confounds of runs, indexed by the
+# content of the confounds and sample mask
+_projectors = OrderedDict()
+_projectors_lock = threading.Lock()
+_projectors_info = {"hits": 0, "misses": 0, "max_size": 32}
+
+
+def _projector_key(confounds, sample_mask):
+    """Key of the projector of a run: a hash of its confounds and sample mask."""
+    key = hashlib.sha1(str((confounds.shape, confounds.dtype.str)).encode("utf-8"))
+    key.update(np.ascontiguousarray(confounds).data)
+    if sample_mask is not None:
+        key.update(np.ascontiguousarray(sample_mask).data)
+        key.update(sample_mask.dtype.str.encode("utf-8"))
+    return key.hexdigest()
+
+
+def _check_sample_mask(sample_mask):
+    """
+    Convert a sample mask to an array that can index volumes: boolean masks
+    are kept, other masks are indices, e.g. an empty list for a run where all
+    volumes are scrubbed.
+    """
+    if sample_mask is None:
+        return None
+    sample_mask = np.asarray(sample_mask)
+    if sample_mask.dtype == bool:
+        return sample_mask
+    return sample_mask.astype(int)
+
+
+def _fit_projector(confounds, sample_mask):
+    """
+    Orthonormal basis of the censored confounds, once demeaned and scaled
+    to unit variance, as `nilearn.signal.clean` with `standardize_confounds`.
+    Confounds that are collinear with the others are dropped.
+    """
+    if sample_mask is not None:
+        confounds = confounds[sample_mask]
+    if confounds.shape[0] == 0:
+        # no volumes are kept, there is nothing to regress out
+        return np.zeros((0, 0))
+    design = np.array(confounds, dtype=np.float64)
+    design -= design.mean(axis=0)
+    std = design.std(axis=0)
+    std[std < np.finfo(np.float64).eps] = 1
+    design /= std
+    q, r, _ = linalg.qr(design, mode="economic", pivoting=True)
+    return q[:, np.abs(np.diag(r)) > np.finfo(np.float64).eps * 100]
+
+
+def _projector(confounds, sample_mask=None):
+    """Get the projector of a run, from the cache if the run was seen before."""
+    confounds = np.asarray(confounds)
+    sample_mask = _check_sample_mask(sample_mask)
+    key = _projector_key(confounds, sample_mask)
+    with _projectors_lock:
+        q = _projectors.get(key)
+        if q is not None:
+            _projectors_info["hits"] += 1
+            _projectors.move_to_end(key)
+            return q
+        _projectors_info["misses"] += 1
+    # runs are factorized outside of the lock, so that threads cleaning
+    # different runs do not wait for each other
+    q = _fit_projector(confounds, sample_mask)
+    q.flags.writeable = False
+    with _projectors_lock:
+        _projectors[key] = q
+        while len(_projectors) > _projectors_info["max_size"]:
+            _projectors.popitem(last=False)
+    return q
+
+
+def _clear_projectors():
+    """Empty the cache of projectors, and reset its counters."""
+    with _projectors_lock:
+        _projectors.clear()
+        _projectors_info.update(hits=0, misses=0)
+
+
+def clean(signals, confounds, sample_mask=None):
+    """
+    Regress confounds out of time series.
+
+    The volumes excluded by the sample mask are removed, the confounds are
+    demeaned, and the signals are projected on the orthogonal complement of
+    the confounds. The QR decomposition of the confounds is cached for each
+    run, so cleaning several signals of the same run (e.g. voxels, then
+    several parcellations) factorizes its confounds only once.
+    The results match `nilearn.signal.clean` on the censored signals and
+    confounds, with `detrend=False` and `standardize=False`.
+
+    Parameters
+    ----------
+    signals : numpy.ndarray
+        The time series, with shape (volumes, features), e.g. as extracted by
+        a nilearn masker.
+
+    confounds : numpy.ndarray or pandas.DataFrame
+        The confounds of the run, with shape (volumes, regressors), as loaded
+        by `Confounds.load`.
+
+    sample_mask : list of int or numpy.ndarray, optional
+        The volumes to keep, as `Confounds.sample_mask_`, or a boolean mask
+        of the volumes. Default is None: all volumes are kept.
+
+    Returns
+    -------
+    signals : numpy.ndarray
+        The cleaned time series of the kept volumes, with shape
+        (kept volumes, features). The mean of each time series is kept.
+        If no volumes are kept, e.g. all volumes are scrubbed, the time
+        series are empty.
+    """
+    signals = np.asarray(signals)
+    if signals.shape[0] != np.shape(confounds)[0]:
+        raise ValueError(
+            f"The signals have {signals.shape[0]} volumes, "
+            f"and the confounds {np.shape(confounds)[0]}."
+        )
+    return _residuals(signals, _projector(confounds, sample_mask), sample_mask)
+
+
+def _residuals(signals, q, sample_mask=None):
+    """Censor the signals, and remove their projection on the confounds basis."""
+    if sample_mask is not None:
+        signals = signals[_check_sample_mask(sample_mask)]
+    dtype = signals.dtype if np.issubdtype(signals.dtype, np.floating) else np.float64
+    # indexing with the sample mask already made a copy
+    signals = signals.astype(dtype, copy=sample_mask is None)
+    signals -= (q @ (q.T @ signals)).astype(dtype, copy=False)
+    return signals
+
+
+def _img_blocks(shape, n_voxels):
+    """
+    Split the volume of an image in blocks of at most `n_voxels` voxels
+    (or one line along x), as slabs of whole slices or of lines of a slice.
+    The blocks are contiguous in each volume of a NIfTI file.
+    """
+    nx, ny, nz = shape
+    n_lines = max(n_voxels // nx, 1)
+    if n_lines >= ny:
+        n_slices = n_lines // ny
+        for z in range(0, nz, n_slices):
+            yield (slice(None), slice(None), slice(z, z + n_slices))
+        return
+    for z in range(nz):
+        for y in range(0, ny, n_lines):
+            yield (slice(None), slice(y, y + n_lines), slice(z, z + 1))
+
+
+def _create_img(output_file, header, n_volumes):
+    """
+    Write the header of a 4-D float32 NIfTI image, and memory-map its data,
+    so the image can be written one block at a time.
+    """
+    header = nib.Nifti1Header.from_header(header)
+    header.set_data_shape(header.get_data_shape()[:3] + (n_volumes,))
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(None, None)
+    header["vox_offset"] = 0  # set after the extensions, when writing
+    with open(output_file, "wb") as f:
+        header.write_to(f)
+        offset = header.get_data_offset()
+        shape = header.get_data_shape()
+        f.truncate(offset + int(np.prod(shape)) * 4)
+    return np.memmap(
+        output_file,
+        dtype=header.get_data_dtype(),
+        mode="r+",
+        offset=offset,
+        shape=shape,
+        order="F",
+    )
+
+
+def clean_img(
+    img_file,
+    confounds,
+    output_file,
+    sample_mask=None,
+    max_nbytes=256 * 2 ** 20,
+    n_jobs=1,
+):
+    """
+    Regress confounds out of a 4-D image, without loading it in memory.
+
+    The image is read one block of voxels at a time, and each block is
+    cleaned as `clean`, and written to the output image, so the memory used
+    is bounded whatever the size of the image. Only the voxels of a block
+    are read from uncompressed images (`.nii`), while compressed images
+    (`.nii.gz`) are decompressed for each block, which is much slower for
+    large images.
+
+    Parameters
+    ----------
+    img_file : path to a 4-D NIfTI image
+        The processed image from fmriprep.
+
+    confounds : numpy.ndarray or pandas.DataFrame
+        The confounds of the run, with shape (volumes, regressors), as loaded
+        by `Confounds.load`.
+
+    output_file : path to a `.nii` file
+        The cleaned image, written in float32 with the volumes of the sample
+        mask. It is written incrementally, so it cannot be compressed.
+
+    sample_mask : list of int or numpy.ndarray, optional
+        The volumes to keep, as `Confounds.sample_mask_`. Default is None:
+        all volumes are kept.
+
+    max_nbytes : int, optional
+        The approximate memory budget of cleaning, in bytes, shared by the
+        blocks processed in parallel (default = 256 MB). Blocks are made of
+        whole lines of voxels, so a block can exceed the budget if a single
+        line does.
+
+    n_jobs : int, optional
+        The number of threads cleaning blocks in parallel (default = 1).
+        -1 means using all processors. Reading blocks is serialized, while
+        the matrix products run in parallel.
+
+    Returns
+    -------
+    img : nibabel.Nifti1Image
+        The cleaned image, memory-mapped from `output_file`.
+    """
+    if str(output_file).endswith(".gz"):
+        raise ValueError(
+            "The cleaned image is written incrementally, and cannot be compressed. "
+            f"Got {output_file}"
+        )
+    img = nib.load(img_file)
+    if len(img.shape) != 4:
+        raise ValueError(f"{img_file} is not a 4-D image.")
+    if img.shape[3] != np.shape(confounds)[0]:
+        raise ValueError(
+            f"The image has {img.shape[3]} volumes, "
+            f"and the confounds {np.shape(confounds)[0]}."
+        )
+    q = _projector(confounds, sample_mask)
+    if q.shape[0] == 0:
+        raise ValueError(f"All the volumes of {img_file} are excluded.")
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    output = _create_img(output_file, img.header, q.shape[0])
+
+    # a block holds the voxels as read, in float, censored and projected
+    n_voxels = max_nbytes // (n_jobs * 4 * img.shape[3] * 8)
+    read_lock = threading.Lock()
+
+    def clean_block(block):
+        """Clean the voxels of a block, and write them to the output image."""
+        with read_lock:
+            data = np.asarray(img.dataobj[block])
+        signals = data.reshape(-1, img.shape[3]).T
+        del data
+        cleaned = _residuals(signals, q, sample_mask)
+        output[block] = cleaned.T.reshape(output[block].shape)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        # consume the results to raise errors of the workers
+        list(executor.map(clean_block, _img_blocks(img.shape[:3], n_voxels)))
+    output.flush()
+    del output
+    return nib.load(output_file)
@@ -0,0 +1,202 @@
+"""Memory-mapped store of the confounds of many runs.
+
+Authors: load_confounds team
+"""
+import os
+import json
+import numpy as np
+
+
+def _run_key(img_file):
+    """Key of a run in the store, gifti pairs are stored as lists."""
+    return tuple(img_file) if isinstance(img_file, list) else img_file
+
+
+def write_store(path, runs):
+    """
+    Write the confounds of many runs in a store.
+
+    Parameters
+    ----------
+    path : path to a directory
+        The directory of the store, created if needed.
+
+    runs : iterable of tuples
+        For each run, the image file(s), confounds array, labels of the columns
+        and sample mask, e.g. as generated by `Confounds.iter_load` with
+        `output="array"`. The runs are written one at a time, with the dtype
+        of the first run. The files of the store are only replaced once all
+        runs are written, so a store is left unchanged if a run fails to load.
+    """
+    os.makedirs(path, exist_ok=True)
+    store_files = ["values.dat", "runs.npz", "store.json"]
+    tmp_files = {name: os.path.join(path, f"{name}.tmp") for name in store_files}
+    try:
+        _write_store_files(tmp_files, runs)
+    except BaseException:
+        for tmp_file in tmp_files.values():
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        raise
+    # the metadata is removed first and replaced last, so the values of the
+    # new store are never read with the metadata of the previous one
+    if os.path.exists(os.path.join(path, "store.json")):
+        os.remove(os.path.join(path, "store.json"))
+    for name in store_files:
+        os.replace(tmp_files[name], os.path.join(path, name))
+
+
+def _write_store_files(files, runs):
+    """Write the values and metadata of the runs of a store in `files`."""
+    labels = {}
+    img_files, lengths, n_columns, columns, sample_masks = [], [], [], [], []
+    dtype = None
+    # the confounds of each run are contiguous, in a flat array concatenated
+    # along time, so each run can be read as a view
+    with open(files["values.dat"], "wb") as f:
+        for img_file, confounds, run_labels, sample_mask in runs:
+            if dtype is None:
+                dtype = np.dtype(confounds.dtype).name
+            np.ascontiguousarray(confounds, dtype=dtype).tofile(f)
+            img_files.append(img_file)
+            lengths.append(confounds.shape[0])
+            n_columns.append(confounds.shape[1])
+            columns.extend(labels.setdefault(col, len(labels)) for col in run_labels)
+            mask = np.ones(confounds.shape[0], dtype=bool)
+            if sample_mask is not None:
+                mask[:] = False
+                mask[sample_mask] = True
+            sample_masks.append(mask)
+
+    # a file object, so that numpy does not add the .npz extension
+    with open(files["runs.npz"], "wb") as f:
+        np.savez(
+            f,
+            lengths=np.array(lengths, dtype=np.int64),
+            n_columns=np.array(n_columns, dtype=np.int64),
+            columns=np.array(columns, dtype=np.int64),
+            sample_mask=np.concatenate(sample_masks + [np.ones(0, dtype=bool)]),
+        )
+    with open(files["store.json"], "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "img_files": img_files,
+                "labels": list(labels),
+                "dtype": dtype or "float64",
+            },
+            f,
+        )
+
+
+class ConfoundsStore:
+    """
+    Memory-mapped store of the confounds of many runs.
+
+    The confounds of all runs are kept in a single binary file, which is
+    memory-mapped when the store is opened. The confounds of each run are
+    read as a view of this file, without parsing or copying.
+    A store is created with `Confounds.export`, or `write_store`.
+
+    Parameters
+    ----------
+    path : path to a directory
+        The directory of the store.
+
+    Attributes
+    ----------
+    `img_files_` : list
+        The processed image files of the runs.
+
+    `labels_` : list of str
+        The labels of all the confounds found in the runs.
+
+    `lengths_` : numpy.ndarray
+        The number of volumes of each run.
+    """
+
+    def __init__(self, path):
+        """Open the store."""
+        self.path = path
+        with open(os.path.join(path, "store.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.img_files_ = meta["img_files"]
+        self.labels_ = meta["labels"]
+        with np.load(os.path.join(path, "runs.npz")) as runs:
+            self.lengths_ = runs["lengths"]
+            self._n_columns = runs["n_columns"]
+            self._columns = runs["columns"]
+            self._sample_mask = runs["sample_mask"]
+        self._sample_mask.flags.writeable = False
+        # offsets of the runs in the values, columns and sample masks
+        sizes = self.lengths_ * self._n_columns
+        self._offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self._col_offsets = np.concatenate([[0], np.cumsum(self._n_columns)])
+        self._mask_offsets = np.concatenate([[0], np.cumsum(self.lengths_)])
+        self._runs = {
+            _run_key(img_file): ind for ind, img_file in enumerate(self.img_files_)
+        }
+        values_file = os.path.join(path, "values.dat")
+        if os.path.getsize(values_file) == 0:  # empty files cannot be mapped
+            self._values = np.zeros(0, dtype=meta["dtype"])
+        else:
+            self._values = np.memmap(values_file, dtype=meta["dtype"], mode="r")
+
+    def __len__(self):
+        """Number of runs in the store."""
+        return len(self.img_files_)
+
+    def get(self, run):
+        """
+        Get the confounds of a run.
+
+        Parameters
+        ----------
+        run : int, or path to processed image file(s)
+            The position of the run in `img_files_`, or its image file(s).
+
+        Returns
+        -------
+        confounds : numpy.ndarray
+            Read-only view of the confounds of the run, (volumes x regressors).
+
+        labels : tuple of str
+            The labels of the confounds columns.
+
+        sample_mask : numpy.ndarray
+            Read-only boolean view, True for the volumes to be preserved in
+            the analysis.
+        """
+        if not isinstance(run, (int, np.integer)):
+            try:
+                run = self._runs[_run_key(run)]
+            except KeyError:
+                raise ValueError(f"Could not find {run} in the store.") from None
+        start = self._offsets[run]
+        shape = (self.lengths_[run], self._n_columns[run])
+        confounds = self._values[start : self._offsets[run + 1]].reshape(shape)
+        columns = self._columns[self._col_offsets[run] : self._col_offsets[run + 1]]
+        labels = tuple(self.labels_[col] for col in columns)
+        sample_mask = self._sample_mask[
+            self._mask_offsets[run] : self._mask_offsets[run + 1]
+        ]
+        return confounds, labels, sample_mask
+
+    def load(self):
+        """
+        Get the confounds of all runs, see `get`.
+
+        Returns
+        -------
+        confounds : list of numpy.ndarray
+
+        labels : list of tuple of str
+
+        sample_mask : list of numpy.ndarray
+        """
+        confounds, labels, sample_mask = [], [], []
+        for run in range(len(self)):
+            run_confounds, run_labels, run_sample_mask = self.get(run)
+            confounds.append(run_confounds)
+            labels.append(run_labels)
+            sample_mask.append(run_sample_mask)
+        return confounds, labels, sample_mask
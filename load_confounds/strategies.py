@@ -67,6 +67,7 @@ class Minimal(Confounds):
         self.strategy = strategy
         self.motion = motion
         self.n_motion = 0
+        self.motion_pca_scope = "run"
         self.wm_csf = wm_csf
         self.demean = demean
         if global_signal:
@@ -155,6 +156,7 @@ class Scrubbing(Confounds):
         self.strategy = strategy
         self.motion = motion
         self.n_motion = 0
+        self.motion_pca_scope = "run"
         self.wm_csf = wm_csf
         self.scrub = scrub
         self.fd_thresh = (fd_thresh,)
@@ -217,6 +219,7 @@ class CompCor(Confounds):
         self.strategy = ["high_pass", "motion", "compcor", "non_steady_state"]
         self.motion = motion
         self.n_motion = 0
+        self.motion_pca_scope = "run"
         self.compcor = compcor
         self.n_compcor = n_compcor
         self.acompcor_combined = acompcor_combined
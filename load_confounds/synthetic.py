@@ -0,0 +1,299 @@
+"""Synthetic fMRIprep derivatives, for benchmarks and stress tests.
+
+Authors: load_confounds team
+"""
+import io
+import os
+import json
+import numpy as np
+import pandas as pd
+from .parser import motion_basic
+
+# suffixes of the confounds files, before and after fMRIprep v20.2.0
+naming_suffixes = {
+    "old": "_desc-confounds_regressors",
+    "new": "_desc-confounds_timeseries",
+}
+
+# suffixes of the processed images
+img_suffix = "_desc-preproc_bold.nii.gz"
+aroma_suffix = "_space-MNI152NLin6Asym_desc-smoothAROMAnonaggr_bold.nii.gz"
+
+# anatomical masks of the aCompCor components
+acompcor_masks = ["combined", "CSF", "WM"]
+
+# fMRIprep thresholds of the motion outliers
+fd_threshold = 0.5
+std_dvars_threshold = 1.5
+
+# mean absolute value of a Student t variable with 3 degrees of freedom
+mean_abs_t3 = 2 * np.sqrt(3) / np.pi
+
+
+def _expand(confounds, params):
+    """Add the derivatives and squares of some confounds, as fMRIprep."""
+    for param in params:
+        derivative = np.concatenate([[np.nan], np.diff(confounds[param])])
+        confounds[f"{param}_derivative1"] = derivative
+        confounds[f"{param}_power2"] = confounds[param] ** 2
+        confounds[f"{param}_derivative1_power2"] = derivative ** 2
+
+
+def _simulate_motion(n_volumes, motion, rng):
+    """Random walk of the translations (mm) and rotations (radians)."""
+    # heavy-tailed steps, so that some volumes are motion outliers, scaled so
+    # that the framewise displacement (sum of the 6 absolute steps) averages
+    # to the level of motion
+    steps = rng.standard_t(3, size=(n_volumes, 6)) * motion / (6 * mean_abs_t3)
+    steps[:, 3:] /= 50  # rotations, on a sphere of 50 mm radius
+    steps[0] = 0
+    params = np.cumsum(steps, axis=0)
+    fd = np.abs(steps[:, :3]).sum(axis=1) + 50 * np.abs(steps[:, 3:]).sum(axis=1)
+    fd[0] = np.nan
+    return params, fd
+
+
+def _indicator(n_volumes, vol):
+    """One-hot encoded regressor of a volume."""
+    indicator = np.zeros(n_volumes)
+    indicator[vol] = 1
+    return indicator
+
+
+def _compcor_components(method, n_components, rng, mask=None):
+    """
+    Json metadata of compcor components, with a decreasing variance explained.
+    The components explaining the first 50% of the variance are retained.
+    """
+    variance = np.sort(rng.dirichlet(np.ones(n_components) * 0.5))[::-1]
+    cumulative = np.cumsum(variance)
+    n_retained = int(np.searchsorted(cumulative, 0.5)) + 1
+    metadata = []
+    for ind in range(n_components):
+        meta = {
+            "CumulativeVarianceExplained": float(cumulative[ind]),
+            "Method": method,
+            "Retained": bool(ind < n_retained),
+            "SingularValue": float(np.sqrt(variance[ind]) * 1000),
+            "VarianceExplained": float(variance[ind]),
+        }
+        if mask is not None:
+            meta["Mask"] = mask
+        metadata.append(meta)
+    return metadata
+
+
+def make_confounds(
+    n_volumes=200,
+    motion=0.1,
+    tr=2.0,
+    n_compcor=50,
+    n_aroma=10,
+    n_non_steady_state=1,
+    random_state=0,
+):
+    """
+    Simulate the confounds of a run, as estimated by fMRIprep.
+
+    Parameters
+    ----------
+    n_volumes : int, default 200
+        The number of volumes of the run.
+
+    motion : float, default 0.1
+        The level of motion: the average framewise displacement, in mm.
+        The framewise displacement has heavy tails, so that some volumes
+        are motion outliers. 0.1 is low motion, 0.5 high motion.
+
+    tr : float, default 2.0
+        The repetition time in seconds, which sets the number of cosines of
+        the 128 s high-pass filter.
+
+    n_compcor : int, default 50
+        The number of tCompCor components, and of aCompCor components of each
+        mask ("combined", "CSF", "WM"), in the json file. The components
+        explaining the first 50% of the variance are retained in the tsv file,
+        the others are listed as "dropped_X".
+
+    n_aroma : int, default 10
+        The number of ICA-AROMA noise components.
+
+    n_non_steady_state : int, default 1
+        The number of non steady state volumes, at the beginning of the run.
+
+    random_state : int or numpy.random.RandomState, default 0
+        Seed of the random number generator.
+
+    Returns
+    -------
+    confounds : pandas.DataFrame
+        The confounds of the run, in the format of the tsv file.
+
+    confounds_json : dict
+        The metadata of the compcor components, in the format of the json file.
+    """
+    rng = np.random.RandomState(random_state)
+    confounds = {}
+    for param in ["global_signal", "csf", "white_matter"]:
+        confounds[param] = 1000 + 10 * rng.randn(n_volumes)
+    _expand(confounds, list(confounds))
+    confounds["std_dvars"] = np.nan
+    confounds["dvars"] = np.nan
+    confounds["framewise_displacement"] = np.nan
+
+    # compcor, with the metadata of retained and dropped components
+    confounds_json = {}
+    components = [("t_comp_cor", "tCompCor", None)]
+    components += [("a_comp_cor", "aCompCor", mask) for mask in acompcor_masks]
+    counts = {"t_comp_cor": 0, "a_comp_cor": 0, "dropped": 0}
+    for prefix, method, mask in components:
+        for meta in _compcor_components(method, n_compcor, rng, mask):
+            # the aCompCor components of all masks share the same numbering
+            if meta["Retained"]:
+                name = f"{prefix}_{counts[prefix]:02d}"
+                confounds[name] = rng.randn(n_volumes) * meta["SingularValue"] / 1000
+                counts[prefix] += 1
+            else:
+                name = f"dropped_{counts['dropped']}"
+                counts["dropped"] += 1
+            confounds_json[name] = meta
+
+    n_cosines = max(int(np.floor(2 * n_volumes * tr / 128)) - 1, 0)
+    time = (np.arange(n_volumes) + 0.5) / n_volumes
+    for ind in range(n_cosines):
+        confounds[f"cosine{ind:02d}"] = np.sqrt(2 / n_volumes) * np.cos(
+            np.pi * (ind + 1) * time
+        )
+    for ind in range(n_non_steady_state):
+        confounds[f"non_steady_state_outlier{ind:02d}"] = _indicator(n_volumes, ind)
+
+    params, fd = _simulate_motion(n_volumes, motion, rng)
+    for ind, param in enumerate(motion_basic):
+        confounds[param] = params[:, ind]
+    _expand(confounds, motion_basic)
+    for ind in range(n_aroma):
+        confounds[f"aroma_motion_{ind:02d}"] = rng.randn(n_volumes)
+
+    # DVARS follow the framewise displacement
+    std_dvars = 1 + 0.1 * rng.randn(n_volumes) + 0.5 * np.nan_to_num(fd)
+    std_dvars[0] = np.nan
+    confounds["framewise_displacement"] = fd
+    confounds["std_dvars"] = std_dvars
+    confounds["dvars"] = std_dvars * 20
+    outliers = (fd > fd_threshold) | (std_dvars > std_dvars_threshold)
+    for ind, vol in enumerate(np.flatnonzero(outliers)):
+        confounds[f"motion_outlier{ind:02d}"] = _indicator(n_volumes, vol)
+    return pd.DataFrame(confounds), confounds_json
+
+
+def _write_tsv(filename, confounds):
+    """Write confounds in a tsv file, faster than `pandas.DataFrame.to_csv`."""
+    body = io.StringIO()
+    np.savetxt(body, confounds.values, fmt="%.10g", delimiter="\t")
+    with open(filename, "w") as f:
+        f.write("\t".join(confounds.columns) + "\n")
+        f.write(body.getvalue().replace("nan", "n/a"))
+
+
+def make_derivatives(
+    root,
+    n_subjects=1,
+    n_runs=1,
+    n_volumes=200,
+    motion=0.1,
+    naming="new",
+    task="rest",
+    space="MNI152NLin2009cAsym",
+    random_state=0,
+    **kwargs,
+):
+    """
+    Write a synthetic fMRIprep derivatives folder.
+
+    For each run, the confounds tsv and json files are written, along with
+    empty placeholder files for the processed image and the ICA-AROMA denoised
+    image, following the fMRIprep layout, e.g.
+    `sub-01/func/sub-01_task-rest_run-1_desc-confounds_timeseries.tsv`.
+
+    Parameters
+    ----------
+    root : path to a directory
+        The derivatives folder, created if needed.
+
+    n_subjects : int, default 1
+        The number of subjects.
+
+    n_runs : int, default 1
+        The number of runs of each subject.
+
+    n_volumes : int or list of int, default 200
+        The number of volumes of each run. If a list, the number of volumes of
+        each run is drawn from it.
+
+    motion : float or list of float, default 0.1
+        The level of motion of each run, see `make_confounds`. If a list,
+        the level of motion of each subject is drawn from it.
+
+    naming : str, default "new"
+        The naming of the confounds files: "new" for
+        `desc-confounds_timeseries` (fMRIprep >= 20.2.0), "old" for
+        `desc-confounds_regressors`.
+
+    task : str, default "rest"
+        The name of the task.
+
+    space : str, default "MNI152NLin2009cAsym"
+        The space of the processed images.
+
+    random_state : int, default 0
+        Seed of the random number generator.
+
+    kwargs
+        Other parameters of `make_confounds`, e.g. `n_compcor`.
+
+    Returns
+    -------
+    img_files : list of str
+        The processed image files, in the order of subjects and runs.
+    """
+    if naming not in naming_suffixes:
+        raise ValueError(
+            f"{naming} is not a valid naming of the confounds files. "
+            f"Valid namings are {list(naming_suffixes)}."
+        )
+    rng = np.random.RandomState(random_state)
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, "dataset_description.json"), "w") as f:
+        json.dump(
+            {
+                "Name": "Synthetic fMRIprep derivatives",
+                "BIDSVersion": "1.4.0",
+                "DatasetType": "derivative",
+                "GeneratedBy": [{"Name": "load_confounds"}],
+            },
+            f,
+        )
+    img_files = []
+    n_digits = max(len(str(n_subjects)), 2)
+    for subject in range(1, n_subjects + 1):
+        sub = f"sub-{subject:0{n_digits}d}"
+        folder = os.path.join(root, sub, "func")
+        os.makedirs(folder, exist_ok=True)
+        sub_motion = rng.choice(np.atleast_1d(motion))
+        for run in range(1, n_runs + 1):
+            prefix = os.path.join(folder, f"{sub}_task-{task}_run-{run}")
+            confounds, confounds_json = make_confounds(
+                n_volumes=int(rng.choice(np.atleast_1d(n_volumes))),
+                motion=sub_motion,
+                random_state=rng.randint(np.iinfo(np.int32).max),
+                **kwargs,
+            )
+            confounds_file = prefix + naming_suffixes[naming]
+            _write_tsv(confounds_file + ".tsv", confounds)
+            with open(confounds_file + ".json", "w") as f:
+                json.dump(confounds_json, f, indent=2)
+            img_file = f"{prefix}_space-{space}{img_suffix}"
+            for file in [img_file, prefix + aroma_suffix]:
+                open(file, "w").close()
+            img_files.append(img_file)
+    return img_files
@@ -0,0 +1,83 @@
+"""Test the index of fMRIprep derivatives."""
+import os
+import load_confounds.parser as lc
+from load_confounds.derivatives import DerivativesIndex
+import pandas as pd
+import pytest
+
+
+path_data = os.path.join(os.path.dirname(lc.__file__), "data")
+file_confounds = os.path.join(
+    path_data, "test_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+)
+
+
+def test_index_lookup():
+    """Test finding confounds files with the index."""
+    index = DerivativesIndex(path_data)
+    assert file_confounds in index.img_files_
+    assert index.get_file_raw(file_confounds) == lc.cf._get_file_raw(file_confounds)
+    gifti = [
+        os.path.join(path_data, f"test_space-fsaverage5_hemi-{hemi}_bold.func.gii")
+        for hemi in ["L", "R"]
+    ]
+    assert index.get_file_raw(gifti) == index.get_file_raw(file_confounds)
+
+    # the size and modification time of existing json files are indexed
+    tsv = index.get_file_raw(file_confounds)
+    assert index.stat(tsv) == lc.cf._file_stat(tsv)
+    assert index.stat(tsv.replace("tsv", "json")) is not None
+    tsv_nonss = os.path.join(path_data, "nonss_desc-confounds_regressors.tsv")
+    assert index.stat(tsv_nonss.replace("tsv", "json")) is None
+
+    # same errors as when probing the file system
+    for prefix in ["invalid", "noconfound"]:
+        img_file = os.path.join(
+            path_data, f"{prefix}_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+        )
+        with pytest.raises(ValueError):
+            index.get_file_raw(img_file)
+
+    # subsets only include the requested runs
+    subset = index.subset([file_confounds])
+    assert list(subset.confounds_) == [tsv[: -len("_desc-confounds_regressors.tsv")]]
+
+
+def test_index_load(tmp_path, monkeypatch):
+    """Test loading confounds with a saved index."""
+    index_file = tmp_path / "index.json"
+    DerivativesIndex(path_data).save(index_file)
+    index = DerivativesIndex.from_file(index_file)
+
+    conf = lc.Confounds(strategy=["motion", "compcor"])
+    lc.cf.clear_cache()
+    reg, mask = conf.load(file_confounds)
+
+    # the file system is not probed when using the index
+    def no_probing(path):
+        raise AssertionError(f"{path} was probed")
+
+    monkeypatch.setattr(lc.cf, "_get_file_raw", no_probing)
+    monkeypatch.setattr(lc.cf, "_file_stat", no_probing)
+    for n_jobs in [1, 2]:
+        reg_index, mask_index = conf.load([file_confounds], n_jobs=n_jobs, index=index)
+        pd.testing.assert_frame_equal(reg, reg_index[0])
+        assert mask == mask_index[0]
+
+    # the binary cache of the tsv file is checked against the index
+    stat = os.stat
+    tsv = index.get_file_raw(file_confounds)
+
+    def no_stat(path, *args, **kwargs):
+        if os.fspath(path) == tsv:
+            raise AssertionError(f"{path} was probed")
+        return stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", no_stat)
+    for _ in range(2):
+        lc.cf.clear_cache()
+        reg_index, _ = conf.load(
+            [file_confounds], cache_dir=tmp_path / "cache", index=index
+        )
+        pd.testing.assert_frame_equal(reg, reg_index[0])
+    assert len(os.listdir(tmp_path / "cache")) == 1
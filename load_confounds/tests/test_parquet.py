@@ -0,0 +1,86 @@
+"""Test the Parquet datasets of confounds."""
+import os
+import load_confounds.parser as lc
+from load_confounds import parquet
+from load_confounds.strategies import Minimal
+from load_confounds.tests.test_parser import _copy_run
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+
+path_data = os.path.join(os.path.dirname(lc.__file__), "data")
+
+
+def _bids_runs(tmp_path):
+    """Copy the example run with the names of several BIDS runs."""
+    return [
+        _copy_run(tmp_path, prefix)
+        for prefix in [
+            "sub-01_task-rest_run-1",
+            "sub-01_task-rest_run-2",
+            "sub-02_ses-1_task-rest_run-1",
+            "sub-11_task-rest_run-1",
+            "sub-01_task-motor_run-1",
+        ]
+    ]
+
+
+def test_entities():
+    """Test reading BIDS entities from file names."""
+    entities = parquet._get_entities(
+        "/data/sub-01/func/sub-01_task-rest_run-2_space-T1w_desc-preproc_bold.nii.gz"
+    )
+    assert entities == {
+        "sub": "01",
+        "ses": None,
+        "task": "rest",
+        "run": "2",
+        "space": "T1w",
+    }
+
+
+def test_parquet(tmp_path):
+    """Test exporting and querying raw and reduced confounds."""
+    img_files = _bids_runs(tmp_path)
+    path = str(tmp_path / "raw")
+    parquet.export_parquet(path, img_files)
+    confounds_raw = pd.read_csv(
+        os.path.join(path_data, "test_desc-confounds_regressors.tsv"), delimiter="\t"
+    )
+
+    confounds = parquet.read_parquet(
+        path, columns=["trans_x"], filters={"task": "rest", "sub": "0*"}
+    )
+    assert list(confounds.columns) == parquet.bids_entities + ["volume", "trans_x"]
+    assert len(confounds) == 3 * len(confounds_raw)
+    assert sorted(set(confounds["sub"])) == ["01", "02"]
+    run = confounds[confounds["ses"] == "1"]
+    assert np.allclose(run["trans_x"], confounds_raw["trans_x"])
+    assert run["volume"].tolist() == list(range(len(confounds_raw)))
+    # runs without a session are read with a missing value
+    assert confounds["ses"].isna().sum() == 2 * len(confounds_raw)
+
+    # only the files of the selected runs are read
+    dataset = parquet._open_dataset(path)
+    expression = parquet._filter_expression({"sub": ["01", "11"], "run": "1"})
+    assert len(list(dataset.get_fragments(filter=expression))) == 3
+
+    with pytest.raises(ValueError):
+        parquet.read_parquet(path, columns=["not_a_column"])
+
+    # confounds of a strategy, with the sample mask
+    path = str(tmp_path / "minimal")
+    conf = Minimal()
+    parquet.export_parquet(path, img_files[:2], strategy=conf)
+    confounds = parquet.read_parquet(path, filters={"run": "2"})
+    reg, sample_mask = conf.load(img_files[1])
+    assert np.allclose(confounds[reg.columns], reg)
+    assert np.flatnonzero(confounds["sample_mask"]).tolist() == sample_mask
+
+    # runs exported later are added to the dataset
+    parquet.export_parquet(path, img_files[2:3], strategy=conf)
+    confounds = parquet.read_parquet(path, columns=["csf"])
+    assert len(confounds) == 3 * len(confounds_raw)
@@ -1,9 +1,17 @@
 import os
+import json
 import re
+import shutil
+import pickle
+import asyncio
+import threading
+import tracemalloc
 import load_confounds.parser as lc
+from load_confounds.synthetic import make_derivatives
 import pandas as pd
 import numpy as np
 from scipy.stats import pearsonr
+from sklearn.decomposition import PCA
 from sklearn.preprocessing import scale
 import pytest
 from nibabel import Nifti1Image
@@ -442,3 +450,657 @@ def test_sample_mask():
     conf = lc.Confounds(strategy=["motion"])
     reg, mask = conf.load(file_no_none_steady)
     assert mask is None
+
+    # all volumes scrubbed: the mean of the confounds is undefined
+    conf = lc.Confounds(strategy=["motion", "scrub"], fd_thresh=0, std_dvars_thresh=0)
+    reg, mask = conf.load(file_confounds)
+    assert len(mask) == 0
+    assert reg.isna().all().all()
+
+
+def test_column_projection():
+    """Test that only the columns required by the strategy are parsed."""
+    conf = lc.Confounds(strategy=["motion", "high_pass"], motion="basic")
+    confounds_raw, confounds_json = lc.cf._confounds_to_df(
+        file_confounds, False, False, conf._find_columns
+    )
+    expected = ["cosine00", "cosine01", "cosine02", "cosine03"]
+    expected += ["non_steady_state_outlier00"]
+    expected += ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+    assert list(confounds_raw.columns) == expected
+
+    # the projection does not change the loaded confounds
+    full_raw, _ = lc.cf._confounds_to_df(file_confounds, False, False)
+    assert full_raw.shape[1] > confounds_raw.shape[1]
+    pd.testing.assert_frame_equal(full_raw[expected], confounds_raw)
+
+    # compcor columns are found through the json file
+    conf = lc.Confounds(strategy=["compcor"], compcor="temp", n_compcor=2)
+    confounds_raw, _ = lc.cf._confounds_to_df(
+        file_confounds, False, False, conf._find_columns
+    )
+    assert list(confounds_raw.columns) == [
+        "t_comp_cor_00",
+        "t_comp_cor_01",
+        "non_steady_state_outlier00",
+    ]
+
+
+def test_parallel_load():
+    """Test loading multiple runs in parallel."""
+    img_files = [file_confounds, file_no_none_steady, file_confounds]
+    conf = lc.Confounds(strategy=["motion", "scrub"], fd_thresh=0.15)
+    reg_serial, mask_serial = conf.load(img_files)
+    reg_parallel, mask_parallel = conf.load(img_files, n_jobs=2)
+    # outputs are in the same order as the inputs
+    assert len(reg_parallel) == 3
+    for serial, parallel in zip(reg_serial, reg_parallel):
+        pd.testing.assert_frame_equal(serial, parallel)
+    assert mask_serial == mask_parallel
+
+    # workers are not sent the outputs of previous loads, nor profiling records
+    conf.profile = lc.Profiler()
+    conf.load(img_files)
+    stateless = conf._stateless()
+    assert not hasattr(stateless, "confounds_")
+    assert not hasattr(stateless, "_profile_records")
+    assert stateless.profile.records_ == []
+    assert len(pickle.dumps(stateless)) < len(pickle.dumps(conf)) / 10
+    reg_parallel, _ = conf.load(img_files, n_jobs=2)
+    pd.testing.assert_frame_equal(reg_serial[0], reg_parallel[0])
+    assert len(conf.profile_["runs"]) == 2
+
+    # missing confounds are merged across runs
+    file_missing_confounds = os.path.join(
+        path_data, "missing_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+    )
+    conf = lc.Confounds(strategy=["high_pass", "motion"], motion="full")
+    with pytest.raises(ValueError) as exc_info:
+        conf.load([file_confounds, file_missing_confounds] * 2, n_jobs=2)
+    assert "['cosine']" in exc_info.value.args[0]
+    assert conf.missing_keys_ == ["cosine"]
+
+
+def _copy_run(tmp_path, prefix="test"):
+    """Copy an example run to a temporary directory."""
+    for suffix in [
+        "_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz",
+        "_desc-confounds_regressors.tsv",
+        "_desc-confounds_regressors.json",
+    ]:
+        shutil.copy(
+            os.path.join(path_data, f"test{suffix}"), tmp_path / f"{prefix}{suffix}"
+        )
+    return str(
+        tmp_path / f"{prefix}_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+    )
+
+
+def test_disk_cache(tmp_path):
+    """Test the binary cache of confounds tsv files."""
+    img_file = _copy_run(tmp_path)
+    cache_dir = tmp_path / "cache"
+    conf = lc.Confounds(strategy=["motion", "high_pass", "compcor"])
+    reg, mask = conf.load(img_file)
+
+    # the first load creates the cache, the second one uses it
+    # the in-memory cache is cleared to force reading from disk
+    lc.cf.clear_cache()
+    reg_write, mask_write = conf.load(img_file, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    lc.cf.clear_cache()
+    reg_read, mask_read = conf.load(img_file, cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(reg, reg_write)
+    pd.testing.assert_frame_equal(reg, reg_read)
+    assert mask == mask_write == mask_read
+
+    # the raw confounds are identical with and without cache
+    tsv_file = img_file.replace(
+        "_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz",
+        "_desc-confounds_regressors.tsv",
+    )
+    pd.testing.assert_frame_equal(
+        lc.cf._read_tsv(tsv_file, dtype="float64"),
+        lc.cf._read_tsv(tsv_file, cache_dir=cache_dir, dtype="float64"),
+    )
+
+    # the cache is refreshed when the tsv file changes
+    confounds_raw = pd.read_csv(tsv_file, delimiter="\t")
+    confounds_raw["trans_x"] = confounds_raw["trans_x"] + 1
+    confounds_raw.to_csv(tsv_file, sep="\t", index=False, na_rep="n/a")
+    conf = lc.Confounds(strategy=["motion"], motion="basic", demean=False)
+    reg_new, _ = conf.load(img_file, cache_dir=cache_dir)
+    assert np.allclose(reg_new["trans_x"], confounds_raw["trans_x"].values)
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_memory_cache(tmp_path):
+    """Test the in-memory cache of raw confounds."""
+    img_file = _copy_run(tmp_path)
+    lc.cf.clear_cache()
+    conf = lc.Confounds(strategy=["motion"], motion="basic", demean=False)
+    reg, _ = conf.load(img_file)
+    assert lc.cf.cache_info()["misses"] == 1
+    reg_cached, _ = conf.load(img_file)
+    assert lc.cf.cache_info()["hits"] == 1
+    pd.testing.assert_frame_equal(reg, reg_cached)
+
+    # a different strategy parses the missing columns only once
+    conf_hp = lc.Confounds(strategy=["motion", "high_pass"], motion="basic")
+    conf_hp.load(img_file)
+    conf_hp.load(img_file)
+    conf.load(img_file)
+    info = lc.cf.cache_info()
+    assert (info["hits"], info["misses"], info["files"]) == (3, 2, 1)
+
+    # the cached frames cannot be modified by callers
+    confounds_raw, confounds_json = lc.cf._confounds_to_df(img_file, False, False)
+    confounds_raw["trans_x"] = 0
+    with pytest.raises(TypeError):
+        confounds_json["a_comp_cor_00"]["Mask"] = "WM"
+    reg_cached, _ = conf.load(img_file)
+    pd.testing.assert_frame_equal(reg, reg_cached)
+
+    # the cache is invalidated when the file changes
+    tsv_file = img_file.replace(
+        "_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz",
+        "_desc-confounds_regressors.tsv",
+    )
+    confounds_raw = pd.read_csv(tsv_file, delimiter="\t")
+    confounds_raw["trans_x"] = confounds_raw["trans_x"] + 1
+    confounds_raw.to_csv(tsv_file, sep="\t", index=False, na_rep="n/a")
+    reg_new, _ = conf.load(img_file)
+    assert np.allclose(reg_new["trans_x"], reg["trans_x"] + 1)
+
+    # the memory budget is respected
+    lc.cf.set_cache_size(0)
+    assert lc.cf.cache_info()["files"] == 0
+    conf.load(img_file)
+    assert lc.cf.cache_info()["nbytes"] == 0
+    lc.cf.set_cache_size(256 * 2 ** 20)
+    lc.cf.clear_cache()
+
+
+def test_iter_load():
+    """Test loading confounds one run at a time."""
+    img_files = [file_confounds, file_no_none_steady]
+    conf = lc.Confounds(strategy=["motion", "scrub"], fd_thresh=0.15)
+    reg, mask = conf.load(img_files)
+
+    conf = lc.Confounds(strategy=["motion", "scrub"], fd_thresh=0.15)
+    runs = conf.iter_load(iter(img_files))
+    for ind, (img_file, reg_run, mask_run) in enumerate(runs):
+        assert img_file == img_files[ind]
+        pd.testing.assert_frame_equal(reg_run, reg[ind])
+        assert mask_run == mask[ind]
+    assert ind == 1
+    # nothing is kept in the object
+    assert not hasattr(conf, "confounds_")
+
+    # a single file is also accepted
+    ((img_file, _, _),) = conf.iter_load(file_confounds)
+    assert img_file == file_confounds
+
+    # missing confounds are reported for the run
+    file_missing_confounds = os.path.join(
+        path_data, "missing_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+    )
+    runs = lc.Confounds(strategy=["high_pass"]).iter_load(
+        [file_confounds, file_missing_confounds]
+    )
+    next(runs)
+    with pytest.raises(ValueError) as exc_info:
+        next(runs)
+    assert "['cosine']" in exc_info.value.args[0]
+
+
+def test_array_output():
+    """Test loading confounds as numpy arrays."""
+    conf = lc.Confounds(strategy=["motion", "high_pass", "scrub"], fd_thresh=0.15)
+    reg, mask = conf.load(file_confounds)
+    reg_array, labels, mask_array = conf.load(file_confounds, output="array")
+    assert isinstance(reg_array, np.ndarray)
+    assert reg_array.dtype == np.float64
+    assert reg_array.flags["C_CONTIGUOUS"]
+    assert labels == tuple(reg.columns)
+    assert np.array_equal(reg_array, reg.values)
+    assert mask_array == mask
+    assert conf.labels_ == labels
+
+    # lists of runs
+    reg_array, labels, mask_array = conf.load(
+        [file_confounds, file_no_none_steady], output="array"
+    )
+    assert len(reg_array) == len(labels) == len(mask_array) == 2
+
+    # motion PCA components are aligned with the other confounds
+    conf = lc.Confounds(strategy=["motion", "high_pass"], n_motion=0.9)
+    reg_array, labels, _ = conf.load(file_confounds, output="array")
+    assert "motion_pca_1" in labels
+    assert not np.isnan(reg_array).any()
+
+    with pytest.raises(ValueError):
+        conf.load(file_confounds, output="list")
+
+
+def test_dtype(tmp_path):
+    """Test loading confounds as float32, parsed with dtype hints."""
+    strategy = ["motion", "high_pass", "wm_csf", "scrub"]
+    conf = lc.Confounds(strategy=strategy, fd_thresh=0.15)
+    reg, mask = conf.load(file_confounds, output="array")[::2]
+    conf = lc.Confounds(strategy=strategy, fd_thresh=0.15, dtype="float32")
+    reg32, _, mask32 = conf.load(file_confounds, output="array")
+    assert reg32.dtype == np.float32
+    assert np.allclose(reg32, reg, atol=1e-4)
+    assert mask32 == mask
+    reg32, _ = conf.load(file_confounds)
+    assert (reg32.dtypes == np.float32).all()
+
+    # the raw confounds are parsed with the dtype, and the outlier
+    # indicators as integers, in memory and in the disk cache
+    (img_file,) = make_derivatives(tmp_path / "derivatives", motion=0.5)
+    cache_dir = tmp_path / "cache"
+    lc.cf.clear_cache()
+    for _ in range(2):
+        confounds_raw, _ = lc.cf._confounds_to_df(
+            img_file, False, False, cache_dir=cache_dir, dtype="float32"
+        )
+        assert confounds_raw["trans_x"].dtype == np.float32
+        assert confounds_raw["non_steady_state_outlier00"].dtype == np.int8
+        assert confounds_raw["motion_outlier00"].dtype == np.int8
+        lc.cf.clear_cache()
+    assert os.listdir(cache_dir)[0].endswith("-float32.npz")
+
+    # batches of runs
+    batch = conf.load_batch([file_confounds, file_confounds])
+    assert batch[0].dtype == np.float32
+
+    with pytest.raises(ValueError):
+        lc.Confounds(dtype="float16")
+    lc.cf.clear_cache()
+
+
+def test_copies():
+    """Count the copies of the confounds made when reducing a run."""
+    n_scans = 2000
+    columns = lc.cf._add_suffix(lc.motion_basic, "full")
+    columns += lc.cf._add_suffix(["csf", "white_matter"], "full")
+    columns += [f"cosine{ind:02d}" for ind in range(40)]
+    confounds_raw = pd.DataFrame(
+        np.random.randn(n_scans, len(columns)), columns=columns
+    )
+    confounds_raw["non_steady_state_outlier00"] = 0
+    confounds_raw.loc[0, "non_steady_state_outlier00"] = 1
+    conf = lc.Confounds(strategy=["motion", "wm_csf", "high_pass"], wm_csf="full")
+
+    tracemalloc.start()
+    sample_mask, confounds, labels, _ = conf._reduce(confounds_raw, {})
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # one copy when selecting the columns of each type of confounds,
+    # and the output array, with demeaning and NaN filling done in place
+    n_copies = peak / confounds.nbytes
+    assert n_copies < 2.5
+    assert confounds.shape == (n_scans, len(columns))
+    assert np.allclose(confounds[1:].mean(axis=0), 0)
+    assert sample_mask == list(range(1, n_scans))
+
+
+def test_outlier_regressors():
+    """Test scrubbing outliers and the one-hot encoded regressors."""
+    conf = lc.Confounds(strategy=["motion", "scrub"], scrub="full", fd_thresh=0.15)
+    confounds_raw, _ = lc.cf._confounds_to_df(
+        file_confounds, False, False, conf._find_columns
+    )
+    # motion outliers are flagged in a single compact column
+    motion_outliers = conf._load_scrub(confounds_raw)
+    assert list(motion_outliers.columns) == ["motion_outlier"]
+    assert motion_outliers["motion_outlier"].dtype == np.int8
+    assert motion_outliers["motion_outlier"].sum() == 8
+
+    reg, mask = conf.load(file_confounds)
+    regressors, labels = lc.cf.outlier_regressors(mask, len(reg))
+    assert regressors.shape == (30, 8)
+    assert labels[0] == "excluded_volume_0"
+    regressors_dense, _ = lc.cf.outlier_regressors(mask, len(reg), dense=True)
+    assert regressors_dense.dtype == np.int8
+    assert np.array_equal(regressors.toarray(), regressors_dense)
+    # each regressor flags a single excluded volume
+    assert np.array_equal(regressors_dense.sum(axis=0), np.ones(8))
+    excluded = np.flatnonzero(regressors_dense.sum(axis=1))
+    assert sorted(set(range(30)) - set(excluded)) == mask
+
+    # non steady state volumes are excluded volumes, not motion outliers
+    conf = lc.Confounds(strategy=["scrub", "non_steady_state"], fd_thresh=0.15)
+    _, mask_nss = conf.load(file_confounds)
+    regressors, labels = lc.cf.outlier_regressors(mask_nss, len(reg))
+    assert regressors.shape[1] == len(reg) - len(mask_nss)
+    assert all(label.startswith("excluded_volume_") for label in labels)
+
+    # without outliers, scrubbing does not generate a sample mask
+    conf = lc.Confounds(strategy=["motion", "scrub"], fd_thresh=10, std_dvars_thresh=10)
+    assert conf._load_scrub(confounds_raw).shape[1] == 0
+    for scrub in ["basic", "full"]:
+        conf.scrub = scrub
+        assert conf.load(file_no_none_steady)[1] is None
+
+    # no regressors without sample mask
+    regressors, labels = lc.cf.outlier_regressors(None, 30)
+    assert regressors.shape == (30, 0)
+    assert labels == []
+
+
+def _optimize_scrub_reference(fd_outliers, n_scans):
+    """Reference loop-based implementation of full scrubbing."""
+    if fd_outliers[0] < 5:
+        fd_outliers = np.asarray(list(range(fd_outliers[0])) + list(fd_outliers))
+    if n_scans - (fd_outliers[-1] + 1) < 5:
+        fd_outliers = np.asarray(
+            list(fd_outliers) + list(range(fd_outliers[-1], n_scans))
+        )
+    fd_outlier_ind_diffs = np.diff(fd_outliers)
+    short_segments_inds = np.where(
+        np.logical_and(fd_outlier_ind_diffs > 1, fd_outlier_ind_diffs < 6)
+    )[0]
+    for ind in short_segments_inds:
+        fd_outliers = np.asarray(
+            list(fd_outliers) + list(range(fd_outliers[ind] + 1, fd_outliers[ind + 1]))
+        )
+    return np.sort(np.unique(fd_outliers))
+
+
+def test_optimize_scrub():
+    """Test full scrubbing against the reference implementation."""
+    rng = np.random.RandomState(42)
+    for _ in range(500):
+        n_scans = rng.randint(1, 100)
+        outliers = rng.rand(n_scans) < rng.rand()
+        if not outliers.any():
+            continue
+        expected = _optimize_scrub_reference(np.flatnonzero(outliers), n_scans)
+        optimized = lc.cf._optimize_scrub(outliers)
+        assert np.array_equal(np.flatnonzero(optimized), expected)
+
+    # the minimum length of the segments can be changed
+    outliers = np.zeros(20, dtype=bool)
+    outliers[[5, 8, 15]] = True
+    optimized = lc.cf._optimize_scrub(outliers, min_segment=4)
+    assert np.flatnonzero(optimized).tolist() == [5, 6, 7, 8, 15]
+    optimized = lc.cf._optimize_scrub(outliers, min_segment=0)
+    assert np.array_equal(optimized, outliers)
+
+
+def test_header_index():
+    """Test the column lookups of a confounds header."""
+    header = lc.cf._get_header(lc.cf._get_file_raw(file_confounds))
+    index = lc.cf._header_index(header)
+    # the index is shared by all files with the same header
+    assert lc.cf._header_index(list(header)) is index
+    assert index.missing(["csf", "not_a_column"]) == ["not_a_column"]
+    params = ["white_matter", "csf", "trans_x"]
+    for keywords in [["cosine"], ["comp_cor"], ["comp_cor_1"], ["aroma", "outlier"]]:
+        expected = [
+            col
+            for col in header
+            if col in params or any(key in col for key in keywords)
+        ]
+        assert lc.cf._select_columns(header, params, keywords) == expected
+    assert index.groups["cosine"] == index.match("cosine")
+
+
+def test_compcor_plans():
+    """Test compcor selection plans are shared by runs with the same layout."""
+    from load_confounds import compcor
+
+    _, confounds_json = lc.cf._confounds_to_df(file_confounds, False, False)
+    confounds_json = dict(confounds_json)
+    layout = compcor._compcor_layout(confounds_json)
+    # a copy of the json, with other metadata, has the same layout
+    json_copy = {key: dict(value) for key, value in confounds_json.items()}
+    json_copy["csf"] = {"Method": "Mean"}
+    assert compcor._compcor_layout(json_copy) is layout
+
+    # selection of the anatomical components by mask
+    cols = compcor._find_compcor(confounds_json, "anat", 5, False)
+    masks = [confounds_json[col]["Mask"] for col in cols]
+    assert masks == ["WM"] * 5 + ["CSF"] * 5
+    assert ("anat", 5, False) in layout["plans"]
+    # the cached plan is not modified by the caller
+    cols.append("csf")
+    assert compcor._find_compcor(json_copy, "anat", 5, False) == cols[:-1]
+
+    # a different compcor layout gets its own plan
+    json_copy["t_comp_cor_99"] = {"Method": "tCompCor"}
+    assert compcor._compcor_layout(json_copy) is not layout
+    n_temp = len(compcor._find_compcor(confounds_json, "temp", "auto", True))
+    assert len(compcor._find_compcor(json_copy, "temp", "auto", True)) == n_temp + 1
+
+
+def test_lazy_json(monkeypatch):
+    """Test the json file is only read for compcor, and only partially."""
+    lc.cf.clear_cache()
+
+    def _get_json(confounds_raw, flag_acompcor):
+        raise AssertionError("the json file should not be read")
+
+    with monkeypatch.context() as m:
+        m.setattr(lc.cf, "_get_json", _get_json)
+        conf = lc.Confounds(strategy=["motion", "high_pass", "wm_csf", "scrub"])
+        conf.load(file_confounds)
+        assert not conf.json_loaded_
+        confounds_raw, confounds_json = lc.cf._confounds_to_df(
+            file_confounds, False, False, load_json=False
+        )
+        assert confounds_json is None
+
+    conf = lc.Confounds(strategy=["compcor"], compcor="anat")
+    conf.load([file_confounds, file_confounds])
+    assert conf.json_loaded_
+    _, confounds_json = lc.cf._confounds_to_df(file_confounds, False, False)
+    # only the compcor entries are kept, with their mask
+    assert len(confounds_json) > 0
+    assert all("_comp_cor" in key for key in confounds_json)
+    assert all(set(entry) <= {"Mask"} for entry in confounds_json.values())
+    assert confounds_json["a_comp_cor_00"]["Mask"] == "combined"
+    # json data found in the cache is not read again
+    conf.load(file_confounds)
+    assert not conf.json_loaded_
+
+    # the json file is loaded for all strategies if one needs it
+    lc.cf.clear_cache()
+    strategies = [lc.Confounds(strategy=["motion"]), conf]
+    lc.load_many(strategies, file_confounds)
+    assert strategies[0].json_loaded_ and strategies[1].json_loaded_
+
+    # json files read to fit a motion PCA shared across runs are reported
+    lc.cf.clear_cache()
+    conf = lc.Confounds(
+        strategy=["motion", "compcor"], n_motion=0.95, motion_pca_scope="dataset"
+    )
+    conf.load(file_confounds)
+    assert conf.json_loaded_
+    lc.cf.clear_cache()
+
+
+def test_motion_pca_scope(tmp_path):
+    """Test the motion PCA fitted across the runs of a subject or a dataset."""
+    img_files = [
+        _copy_run(tmp_path, prefix)
+        for prefix in ["sub-01_run-1", "sub-01_run-2", "sub-02_run-1"]
+    ]
+    # make the runs of a subject different
+    tsv_file = img_files[1].replace(
+        "_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz",
+        "_desc-confounds_regressors.tsv",
+    )
+    confounds_raw = pd.read_csv(tsv_file, delimiter="\t")
+    confounds_raw["trans_x"] = confounds_raw["trans_x"] * 2 + confounds_raw["rot_y"]
+    confounds_raw.to_csv(tsv_file, sep="\t", index=False, na_rep="n/a")
+
+    def _std_motion(img_file):
+        confounds_raw, _ = lc.cf._confounds_to_df(img_file, False, False)
+        params = lc.cf._add_suffix(lc.motion_basic, "full")
+        return scale(confounds_raw[params].dropna())
+
+    conf = lc.Confounds(strategy=["motion"], n_motion=3, motion_pca_scope="subject")
+    reg, _ = conf.load(img_files)
+    assert sorted(conf.motion_pca_) == ["sub-01", "sub-02"]
+    assert list(reg[0].columns) == ["motion_pca_1", "motion_pca_2", "motion_pca_3"]
+    # the runs of a subject are projected on the components of all its runs
+    pca = PCA(n_components=3).fit(
+        np.concatenate([_std_motion(img_file) for img_file in img_files[:2]])
+    )
+    for run in range(2):
+        expected = pca.transform(_std_motion(img_files[run]))
+        expected = expected - expected.mean(axis=0)
+        assert np.allclose(np.abs(reg[run].values[1:]), np.abs(expected))
+    # a subject with a single run gets the same components as a PCA per run
+    reg_run, _ = lc.Confounds(strategy=["motion"], n_motion=3).load(img_files[2])
+    assert np.allclose(np.abs(reg[2].values[1:]), np.abs(reg_run.values[1:]))
+
+    # the runs are loaded one at a time to fit the PCA, with a fraction of variance
+    conf = lc.Confounds(strategy=["motion"], n_motion=0.95, motion_pca_scope="dataset")
+    reg, _ = conf.load(img_files)
+    assert list(conf.motion_pca_) == ["dataset"]
+    assert len({confounds.shape[1] for confounds in reg}) == 1
+    for (_, confounds, _), reg_single in zip(conf.iter_load(img_files), reg):
+        pd.testing.assert_frame_equal(confounds, reg_single)
+
+    with pytest.raises(ValueError):
+        lc.Confounds(strategy=["motion"], n_motion=3, motion_pca_scope="session")
+
+    # runs of unknown subjects are not pooled
+    conf = lc.Confounds(strategy=["motion"], n_motion=0.95, motion_pca_scope="subject")
+    with pytest.raises(ValueError, match="sub-"):
+        conf.load([file_confounds, file_no_none_steady])
+
+    # the scope follows the other parameters, which can be passed by position
+    conf = lc.Confounds(["motion"], "full", 0, "basic")
+    assert conf.scrub == "basic"
+    assert conf.motion_pca_scope == "run"
+
+
+def test_load_batch(tmp_path):
+    """Test loading runs with the same number of volumes in a batch."""
+    img_files = [_copy_run(tmp_path, f"run{run}") for run in range(3)]
+    conf = lc.Confounds(
+        strategy=["motion", "high_pass", "wm_csf", "scrub", "compcor"],
+        compcor="temp",
+        fd_thresh=0.15,
+    )
+    reg, labels, mask = conf.load(img_files, output="array")
+    confounds, labels_batch, sample_mask, valid = conf.load_batch(img_files, n_jobs=2)
+    assert confounds.shape == (3, 30, len(labels[0]))
+    assert labels_batch == labels[0]
+    assert valid.all()
+    assert sample_mask.dtype == bool
+    for run in range(3):
+        assert np.allclose(confounds[run], reg[run])
+        assert np.flatnonzero(sample_mask[run]).tolist() == mask[run]
+    assert conf.confounds_ is confounds
+
+    # all volumes scrubbed, as with `load`
+    conf_all = lc.Confounds(["motion", "scrub"], fd_thresh=0, std_dvars_thresh=0)
+    confounds, _, sample_mask, _ = conf_all.load_batch(img_files)
+    assert not sample_mask.any()
+    assert np.isnan(confounds).all()
+
+    # runs with a different number of compcor components
+    json_file = img_files[1].replace(
+        "_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz",
+        "_desc-confounds_regressors.json",
+    )
+    with open(json_file) as f:
+        confounds_json = json.load(f)
+    del confounds_json["t_comp_cor_05"]
+    with open(json_file, "w") as f:
+        json.dump(confounds_json, f)
+    with pytest.raises(ValueError, match=r"runs \[1\]"):
+        conf.load_batch(img_files)
+    confounds, labels_batch, _, valid = conf.load_batch(img_files, pad=True)
+    assert labels_batch == labels[0]
+    padded = labels_batch.index("t_comp_cor_05")
+    assert not valid[1, padded] and valid[1].sum() == len(labels_batch) - 1
+    assert np.all(confounds[1, :, padded] == 0)
+    assert np.allclose(confounds[0], reg[0])
+
+    # runs with a different number of volumes
+    tsv_file = json_file.replace("json", "tsv")
+    confounds_raw = pd.read_csv(tsv_file, delimiter="\t")
+    confounds_raw[:20].to_csv(tsv_file, sep="\t", index=False, na_rep="n/a")
+    with pytest.raises(ValueError, match="number of volumes"):
+        conf.load_batch(img_files, pad=True)
+
+
+def test_aload(tmp_path):
+    """Test loading runs with asyncio."""
+    img_files = [_copy_run(tmp_path, f"run{run}") for run in range(5)]
+    conf = lc.Confounds(
+        strategy=["motion", "high_pass", "scrub", "compcor"], fd_thresh=0.15
+    )
+    reg, mask = conf.load(img_files)
+
+    async def load_and_tick():
+        """Load the runs, while checking the event loop is not blocked."""
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0)
+
+        ticker = asyncio.ensure_future(tick())
+        outputs = await conf.aload(img_files, concurrency=3)
+        ticker.cancel()
+        return outputs, len(ticks)
+
+    (reg_async, mask_async), n_ticks = asyncio.run(load_and_tick())
+    assert n_ticks > 0
+    assert mask_async == mask
+    for run in range(5):
+        pd.testing.assert_frame_equal(reg_async[run], reg[run])
+    assert conf.confounds_ is reg_async
+
+    # single run, array output
+    reg_single, labels, mask_single = asyncio.run(
+        conf.aload(img_files[0], concurrency=1, output="array")
+    )
+    assert np.allclose(reg_single, reg[0].to_numpy())
+    assert list(labels) == list(reg[0].columns)
+    assert mask_single == mask[0]
+
+    # missing confounds are reported as with `load`
+    file_missing_confounds = os.path.join(
+        path_data, "missing_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+    )
+    conf = lc.Confounds(strategy=["high_pass", "motion"])
+    with pytest.raises(ValueError, match="cosine"):
+        asyncio.run(conf.aload([img_files[0], file_missing_confounds]))
+
+    # when a run fails, the runs not started yet are cancelled
+    file_not_found = file_missing_confounds.replace("missing", "notfound")
+    started = []
+    next_started = threading.Event()
+    release = threading.Event()
+
+    def load_single(img_file, *args):
+        started.append(img_file)
+        if img_file == file_not_found:
+            # the failure is handled once the next run holds the only worker
+            load_single.loop.call_soon_threadsafe(next_started.wait)
+        else:
+            load_single.thread = threading.current_thread()
+            next_started.set()
+            release.wait()
+        return lc.Confounds._load_single(conf, img_file, *args)
+
+    async def aload_failing():
+        load_single.loop = asyncio.get_running_loop()
+        await conf.aload([file_not_found] + img_files, concurrency=1)
+
+    conf._load_single = load_single
+    with pytest.raises(ValueError):
+        asyncio.run(aload_failing())
+    release.set()
+    load_single.thread.join()
+    assert started == [file_not_found, img_files[0]]
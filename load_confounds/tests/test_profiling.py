@@ -0,0 +1,76 @@
+"""Test the profiling of the stages of loading confounds."""
+import os
+import json
+import load_confounds.parser as lc
+from load_confounds import confounds as cf
+from load_confounds import profiling
+from load_confounds import Profiler, Scrubbing
+from load_confounds.synthetic import make_derivatives
+
+
+class _Hook(Profiler):
+    """Profiler keeping the slow stages only."""
+
+    def add(self, record):
+        if record["time"] > 0 and record["stage"] != "total":
+            super().add(record)
+
+
+def test_profile(tmp_path):
+    """Test recording the stages of loading runs."""
+    img_files = make_derivatives(tmp_path, n_subjects=2, n_runs=2)
+    conf = lc.Confounds(["motion", "high_pass", "scrub", "compcor"], n_motion=0.95)
+    conf.load(img_files)
+    assert conf.profile_ is None
+
+    cf.clear_cache()
+    conf.profile = True
+    conf.load(img_files)
+    profile = json.loads(json.dumps(conf.profile_))
+    assert len(profile["runs"]) == 4
+    run = profile["runs"][0]
+    assert run["run"] == img_files[0]
+    assert run["peak"] is None
+    for stage in ["resolve", "read_json", "read_tsv", "load_scrub", "pca", "prepare"]:
+        assert run["stages"][stage]["count"] == 1
+        assert profile["stages"][stage]["count"] == 4
+    tsv_file = img_files[0].split("_space-")[0] + "_desc-confounds_timeseries.tsv"
+    assert run["stages"]["read_tsv"]["bytes"] == os.path.getsize(tsv_file)
+    assert run["bytes"] >= os.path.getsize(tsv_file) > 0
+    assert profile["time"] >= sum(run["time"] for run in profile["runs"]) > 0
+    # the files are read from the in-memory cache
+    conf.load(img_files)
+    assert "read_tsv" not in conf.profile_["stages"]
+
+    # a profiler with a hook, tracing memory, and a PCA fitted across runs
+    cf.clear_cache()
+    hook = _Hook(memory=True)
+    conf = lc.Confounds(
+        ["motion"], n_motion=0.95, motion_pca_scope="subject", profile=hook
+    )
+    conf.load(img_files, n_jobs=2)
+    assert {record["stage"] for record in hook.records_} >= {"fit_motion_pca", "pca"}
+    if profiling._trace_peaks:
+        assert all(record["peak"] >= 0 for record in hook.records_)
+    else:
+        assert all(record["peak"] is None for record in hook.records_)
+    assert conf.profile_["stages"]["fit_motion_pca"]["count"] == 2
+    assert "sub-01" in [run["run"] for run in conf.profile_["runs"]]
+
+    # predefined strategies, with batches and iterators
+    conf = Scrubbing()
+    conf.profile = True
+    conf.load_batch(img_files)
+    assert conf.profile_["stages"]["prepare_batch"]["count"] == 1
+    assert len(list(conf.iter_load(img_files))) == 4
+    assert conf.profile_["stages"]["load_scrub"]["count"] == 4
+
+
+def test_profile_without_peaks(tmp_path, monkeypatch):
+    """Test memory is not traced when peaks cannot be reset (python < 3.9)."""
+    monkeypatch.setattr(profiling, "_trace_peaks", False)
+    img_files = make_derivatives(tmp_path, n_runs=2, n_volumes=100)
+    conf = lc.Confounds(profile=Profiler(memory=True))
+    conf.load(img_files)
+    assert all(record["peak"] is None for record in conf.profile.records_)
+    assert conf.profile_["runs"][0]["peak"] is None
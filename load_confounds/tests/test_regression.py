@@ -0,0 +1,105 @@
+"""Test the regression of confounds out of time series."""
+import os
+import load_confounds.parser as lc
+from load_confounds import regression
+import numpy as np
+import pytest
+from nibabel import Nifti1Image
+from nilearn.signal import clean as nilearn_clean
+
+path_data = os.path.join(os.path.dirname(lc.__file__), "data")
+file_confounds = os.path.join(
+    path_data, "test_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+)
+
+
+def test_clean():
+    """Test cleaning signals matches nilearn, with cached projectors."""
+    conf = lc.Confounds(strategy=["motion", "high_pass", "scrub"], fd_thresh=0.15)
+    confounds, sample_mask = conf.load(file_confounds)
+    rng = np.random.RandomState(0)
+    motion = confounds.values[:, :3].sum(axis=1, keepdims=True)
+    signals = 100 + rng.randn(len(confounds), 20) + motion
+    expected = nilearn_clean(
+        signals[sample_mask],
+        detrend=False,
+        standardize=False,
+        confounds=confounds.values[sample_mask],
+    )
+
+    regression._clear_projectors()
+    cleaned = regression.clean(signals, confounds, sample_mask)
+    assert cleaned.shape == (len(sample_mask), 20)
+    assert np.allclose(cleaned, expected)
+    # the signals are not modified, and their mean is kept
+    assert np.allclose(cleaned.mean(axis=0), signals[sample_mask].mean(axis=0))
+
+    # other signals of the run reuse the factorization of the confounds
+    cleaned = regression.clean(signals[:, :5], confounds.values, sample_mask)
+    assert np.allclose(cleaned, expected[:, :5])
+    assert regression._projectors_info["misses"] == 1
+    assert regression._projectors_info["hits"] == 1
+
+    # a different sample mask is a different run
+    cleaned = regression.clean(signals, confounds)
+    assert np.allclose(
+        cleaned,
+        nilearn_clean(
+            signals, detrend=False, standardize=False, confounds=confounds.values
+        ),
+    )
+    assert regression._projectors_info["misses"] == 2
+
+    # single precision signals stay in single precision
+    cleaned = regression.clean(signals.astype(np.float32), confounds, sample_mask)
+    assert cleaned.dtype == np.float32
+    assert np.allclose(cleaned, expected, atol=1e-3)
+
+    # collinear confounds are dropped
+    collinear = np.hstack([confounds.values, confounds.values[:, :2]])
+    assert np.allclose(regression.clean(signals, collinear, sample_mask), expected)
+
+    # boolean masks, and runs where all volumes are scrubbed
+    mask = np.zeros(len(confounds), dtype=bool)
+    mask[sample_mask] = True
+    assert np.allclose(regression.clean(signals, confounds, mask), expected)
+    assert regression.clean(signals, confounds, []).shape == (0, 20)
+
+    with pytest.raises(ValueError):
+        regression.clean(signals[1:], confounds, sample_mask)
+    regression._clear_projectors()
+
+
+@pytest.mark.parametrize("suffix", [".nii", ".nii.gz"])
+def test_clean_img(tmp_path, suffix):
+    """Test cleaning an image block by block matches cleaning it in memory."""
+    conf = lc.Confounds(strategy=["motion", "high_pass", "scrub"], fd_thresh=0.15)
+    confounds, sample_mask = conf.load(file_confounds)
+    rng = np.random.RandomState(0)
+    shape = (6, 5, 4, len(confounds))
+    data = (100 + rng.randn(*shape)).astype(np.float32)
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    img_file = str(tmp_path / f"img{suffix}")
+    Nifti1Image(data, affine).to_filename(img_file)
+    expected = regression.clean(data.reshape(-1, shape[3]).T, confounds, sample_mask)
+    expected = expected.T.reshape(shape[:3] + (len(sample_mask),))
+
+    # budgets of several slices, a few lines, and less than a line
+    for n_voxels, n_jobs in [(60, 1), (12, 2), (1, 3)]:
+        max_nbytes = n_voxels * n_jobs * 4 * shape[3] * 8
+        output_file = tmp_path / f"cleaned_{n_voxels}.nii"
+        img = regression.clean_img(
+            img_file, confounds, output_file, sample_mask, max_nbytes, n_jobs
+        )
+        assert img.shape == expected.shape
+        assert img.get_data_dtype() == np.float32
+        assert np.allclose(img.affine, affine)
+        assert np.allclose(img.get_fdata(), expected, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        regression.clean_img(img_file, confounds, tmp_path / "cleaned.nii.gz")
+    with pytest.raises(ValueError):
+        regression.clean_img(img_file, confounds[1:], tmp_path / "cleaned.nii")
+    with pytest.raises(ValueError):
+        regression.clean_img(img_file, confounds, tmp_path / "cleaned.nii", [])
+    regression._clear_projectors()
@@ -0,0 +1,92 @@
+"""Test the memory-mapped store of confounds."""
+import os
+import json
+import load_confounds.parser as lc
+from load_confounds.store import ConfoundsStore
+from load_confounds.tests.test_parser import _copy_run
+import numpy as np
+import pytest
+
+path_data = os.path.join(os.path.dirname(lc.__file__), "data")
+file_confounds = os.path.join(
+    path_data, "test_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+)
+
+
+def test_store(tmp_path):
+    """Test writing and reading confounds in a store."""
+    # a run with fewer compcor components
+    file_sub = _copy_run(tmp_path, "sub")
+    with open(tmp_path / "sub_desc-confounds_regressors.json") as f:
+        confounds_json = json.load(f)
+    del confounds_json["t_comp_cor_05"]
+    with open(tmp_path / "sub_desc-confounds_regressors.json", "w") as f:
+        json.dump(confounds_json, f)
+
+    img_files = [file_confounds, file_sub, file_confounds]
+    conf = lc.Confounds(
+        strategy=["motion", "high_pass", "scrub", "compcor"],
+        compcor="temp",
+        fd_thresh=0.15,
+    )
+    reg, labels, sample_mask = conf.load(img_files, output="array")
+    store = conf.export(img_files, tmp_path / "store")
+    assert len(store) == 3
+    assert store.img_files_ == img_files
+
+    store = ConfoundsStore(tmp_path / "store")
+    confounds, labels_store, sample_mask_store = store.load()
+    for run in range(3):
+        assert np.array_equal(confounds[run], reg[run])
+        assert labels_store[run] == labels[run]
+        assert np.flatnonzero(sample_mask_store[run]).tolist() == sample_mask[run]
+    assert len(labels_store[1]) == len(labels_store[0]) - 1
+
+    # the confounds are read-only views of the memory-mapped file
+    confounds, _, mask = store.get(file_sub)
+    assert isinstance(confounds.base, np.memmap)
+    with pytest.raises(ValueError):
+        confounds[0, 0] = 0
+    with pytest.raises(ValueError):
+        mask[0] = False
+    with pytest.raises(ValueError):
+        store.get(os.path.join(path_data, "missing.nii.gz"))
+
+    # runs without outliers keep all volumes
+    file_nonss = os.path.join(
+        path_data, "nonss_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+    )
+    store = lc.Confounds(strategy=["motion"]).export(file_nonss, tmp_path / "motion")
+    _, labels_store, mask = store.get(0)
+    assert len(labels_store) == 24
+    assert mask.all()
+
+
+def test_store_failed_export(tmp_path):
+    """Test a failed export leaves the previous store unchanged."""
+    file_missing_confounds = os.path.join(
+        path_data, "missing_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
+    )
+    conf = lc.Confounds(strategy=["motion", "high_pass"])
+    reg, labels, _ = conf.load(file_confounds, output="array")
+    conf.export([file_confounds] * 3, tmp_path / "store")
+    with pytest.raises(ValueError):
+        conf.export([file_confounds, file_missing_confounds], tmp_path / "store")
+    assert sorted(os.listdir(tmp_path / "store")) == [
+        "runs.npz",
+        "store.json",
+        "values.dat",
+    ]
+    store = ConfoundsStore(tmp_path / "store")
+    assert len(store) == 3
+    for run in range(3):
+        confounds, labels_store, _ = store.get(run)
+        assert np.array_equal(confounds, reg)
+        assert list(labels_store) == list(labels)
+
+    # a failed export to a new directory leaves no store to open
+    with pytest.raises(ValueError):
+        conf.export([file_confounds, file_missing_confounds], tmp_path / "new")
+    assert os.listdir(tmp_path / "new") == []
+    with pytest.raises(FileNotFoundError):
+        ConfoundsStore(tmp_path / "new")
@@ -255,3 +255,44 @@ def test_invalid():
     with pytest.warns(UserWarning) as record:
         lc.ICAAROMA(compcor="anat", global_signal="full")
     assert "not taking effect: ['compcor']" in record[0].message.args[0]
+
+
+def test_load_many():
+    """Test loading several strategies with a single parse of each run."""
+    from load_confounds import Confounds, load_many
+    from load_confounds import confounds as cf
+
+    strategies = [
+        lc.Minimal(),
+        lc.Scrubbing(fd_thresh=0.15),
+        lc.CompCor(compcor="full", acompcor_combined=False),
+        Confounds(strategy=["motion", "compcor"], compcor="temp", n_compcor=2),
+    ]
+    img_files = [file_confounds, file_confounds]
+    cf.clear_cache()
+    outputs = load_many(strategies, img_files)
+    # a single miss per run: both runs share the same confounds file
+    assert cf.cache_info()["misses"] == 1
+
+    assert len(outputs) == len(strategies)
+    for strategy, (confounds, sample_mask) in zip(strategies, outputs):
+        assert strategy.confounds_ is confounds
+        assert len(confounds) == 2
+        cf.clear_cache()
+        confounds_single, sample_mask_single = strategy.load(file_confounds)
+        for run in range(2):
+            pd.testing.assert_frame_equal(confounds[run], confounds_single)
+            assert sample_mask[run] == sample_mask_single
+
+    # a single input gives a single output per strategy
+    (confounds, _), _, _, _ = load_many(strategies, file_confounds)
+    assert isinstance(confounds, pd.DataFrame)
+
+    # strategies with different dtypes share a float64 parse
+    minimal = lc.Minimal()
+    minimal.dtype = "float32"
+    (confounds, _), (confounds64, _) = load_many(
+        [minimal, lc.Minimal()], file_confounds
+    )
+    assert (confounds.dtypes == np.float32).all()
+    assert np.allclose(confounds, confounds64, atol=1e-4)
@@ -0,0 +1,81 @@
+"""Test the synthetic fMRIprep derivatives."""
+import os
+import json
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pytest
+import load_confounds.parser as lc
+from load_confounds import DerivativesIndex
+from load_confounds.synthetic import make_confounds, make_derivatives, aroma_suffix
+
+
+def test_make_confounds():
+    """Check the confounds of a synthetic run are consistent with their metadata."""
+    confounds, confounds_json = make_confounds(n_volumes=300, motion=0.3)
+    assert confounds.shape[0] == 300
+    assert np.isnan(confounds["framewise_displacement"][0])
+    assert confounds["non_steady_state_outlier00"][0] == 1
+
+    # retained compcor components are in the tsv, the others are dropped
+    retained = [col for col, meta in confounds_json.items() if meta["Retained"]]
+    assert retained == list(confounds.filter(regex="comp_cor").columns)
+    dropped = [col for col in confounds_json if col not in retained]
+    assert all(col.startswith("dropped_") for col in dropped)
+    masks = [confounds_json[col].get("Mask") for col in retained]
+    assert set(masks) == {None, "combined", "CSF", "WM"}
+
+    # motion outliers are flagged from the framewise displacement and DVARS
+    outliers = (confounds["framewise_displacement"] > 0.5) | (
+        confounds["std_dvars"] > 1.5
+    )
+    motion_outliers = confounds.filter(like="motion_outlier")
+    assert motion_outliers.shape[1] == outliers.sum() > 0
+    assert (motion_outliers.sum(axis=1) == outliers).all()
+
+    # long runs with many outliers only hold one column per outlier
+    tracemalloc.start()
+    confounds, _ = make_confounds(n_volumes=3000, motion=0.5)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert confounds.filter(like="motion_outlier").shape[1] > 500
+    assert peak < 4 * confounds.memory_usage().sum()
+
+
+def test_make_derivatives(tmp_path):
+    """Check synthetic derivatives can be indexed and loaded."""
+    img_files = make_derivatives(
+        tmp_path, n_subjects=2, n_runs=3, n_volumes=[100, 150], naming="old"
+    )
+    assert len(img_files) == 6
+    assert os.path.basename(img_files[-1]).startswith("sub-02_task-rest_run-3_")
+    index = DerivativesIndex(tmp_path)
+    assert len(index.img_files_) == 12  # with the ICA-AROMA images
+    assert set(img_files) <= set(index.img_files_)
+    assert all(os.path.getsize(img_file) == 0 for img_file in img_files)
+    confounds_raw = index.get_file_raw(img_files[0])
+    assert confounds_raw.endswith("_desc-confounds_regressors.tsv")
+    with open(confounds_raw.replace("tsv", "json")) as f:
+        assert "a_comp_cor_00" in json.load(f)
+    assert pd.read_csv(confounds_raw, sep="\t").isna().sum().sum() > 0
+
+    conf = lc.Confounds(["motion", "high_pass", "compcor"], compcor="anat")
+    confounds, sample_mask = conf.load(img_files, index=index)
+    assert {len(run) for run in confounds} == {100, 150}
+    assert all(mask[0] == 1 for mask in sample_mask)  # non steady state
+    assert not any(run.isna().any().any() for run in confounds)
+
+    aroma_files = [file.split("_space-")[0] + aroma_suffix for file in img_files]
+    assert len(lc.Confounds(["ica_aroma"], ica_aroma="full").load(aroma_files)[0]) == 6
+
+    # the same seed gives the same derivatives, with the new naming by default
+    img_files = make_derivatives(tmp_path / "new", n_subjects=2, random_state=1)
+    confounds, _ = lc.Confounds().load(img_files)
+    img_files = make_derivatives(tmp_path / "same", n_subjects=2, random_state=1)
+    assert lc.Confounds().load(img_files)[0][1].equals(confounds[1])
+    assert os.path.exists(
+        img_files[0].split("_space-")[0] + "_desc-confounds_timeseries.tsv"
+    )
+
+    with pytest.raises(ValueError):
+        make_derivatives(tmp_path, naming="fmriprep")
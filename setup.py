@@ -29,8 +29,11 @@ setup(
         "pandas>=0.25.3",
         "scikit-learn>=0.21.3",
         "scipy>=1.3.2",
+        "joblib>=0.14",
         "nilearn>=0.7.1",
+        "nibabel>=2.5.0",
     ],  # external packages as dependencies
+    extras_require={"parquet": ["pyarrow"]},
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",